@@ -0,0 +1,315 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Collection, Deque, Dict, Optional
+
+from metrics import REGISTRY
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+admission_wait_histogram = REGISTRY.histogram(
+    "hotline_admission_wait_seconds", "Время ожидания обращения в очереди на отправку", ["priority"]
+)
+delivery_latency_histogram = REGISTRY.histogram(
+    "hotline_delivery_seconds", "Время от отправки обращения студентом до завершения доставки", ["priority"]
+)
+admission_queue_gauge = REGISTRY.gauge(
+    "hotline_admission_queue_length", "Количество обращений в очереди на отправку", ["priority"]
+)
+admission_active_gauge = REGISTRY.gauge(
+    "hotline_admission_active", "Количество обращений, отправляемых в данный момент"
+)
+admission_rejected_counter = REGISTRY.counter(
+    "hotline_admission_rejected_total", "Количество обращений, отклоненных из-за переполнения очереди", ["priority"]
+)
+channel_wait_histogram = REGISTRY.histogram(
+    "hotline_channel_wait_seconds", "Время ожидания свободного слота канала доставки", ["channel", "priority"]
+)
+
+# Колбэк уведомления о месте в очереди (позиция начинается с 1)
+PositionCallback = Callable[[int], Awaitable[None]]
+
+DEFAULT_PRIORITY = "normal"
+
+
+def parse_weights(value: str) -> Dict[str, int]:
+    """Разбор весов классов вида «urgent=4,normal=1»"""
+    weights = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, weight = item.split("=")
+        weights[name.strip()] = int(weight)
+    return weights
+
+
+def parse_priorities(value: str) -> Dict[str, str]:
+    """Разбор классов инстанций вида «Организация питания=low;Нарушение прав обучающихся=urgent»"""
+    priorities = {}
+    for item in value.split(";"):
+        if not item.strip():
+            continue
+        instance, priority = item.rsplit("=", 1)
+        priorities[instance.strip()] = priority.strip()
+    return priorities
+
+
+class AdmissionRejected(Exception):
+    """Очередь на отправку переполнена"""
+
+
+class Waiter:
+    """Обращение в очереди на отправку"""
+
+    __slots__ = ("future", "priority", "tag")
+
+    def __init__(self, future: asyncio.Future, priority: str, tag: float) -> None:
+        self.future = future
+        self.priority = priority
+        self.tag = tag
+
+
+class ChannelSlots:
+    """
+    Слоты канала доставки с резервом для срочных обращений.
+
+    Обычные обращения занимают не больше limit - reserved слотов;
+    срочные могут занять все и обслуживаются первыми.
+    """
+
+    def __init__(self, limit: int, reserved: int = 0) -> None:
+        self.limit = limit
+        # Хотя бы один слот всегда остается обычным обращениям
+        self.reserved = max(0, min(reserved, limit - 1))
+        self.in_use = 0
+        self.waiting: Dict[bool, Deque[asyncio.Future]] = {True: deque(), False: deque()}
+
+    def _has_capacity(self, urgent: bool) -> bool:
+        return self.in_use < (self.limit if urgent else self.limit - self.reserved)
+
+    def _wake(self) -> None:
+        for urgent in (True, False):
+            queue = self.waiting[urgent]
+            while queue and self._has_capacity(urgent):
+                future = queue.popleft()
+                if not future.done():
+                    self.in_use += 1
+                    future.set_result(None)
+
+    async def acquire(self, urgent: bool = False) -> None:
+        if self._has_capacity(urgent) and not self.waiting[True] and (urgent or not self.waiting[False]):
+            self.in_use += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self.waiting[urgent]
+        queue.append(future)
+        try:
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                self.release()
+            elif future in queue:
+                queue.remove(future)
+            raise
+
+    def release(self) -> None:
+        self.in_use -= 1
+        self._wake()
+
+
+class AdmissionController:
+    """
+    Ограничение числа одновременно отправляемых обращений.
+
+    Не более max_concurrent обращений обрабатываются одновременно, остальные
+    ждут в очереди (не длиннее max_queue). Работа с каждым каналом
+    доставки дополнительно ограничена собственным лимитом.
+
+    Очередь взвешенно-справедливая: каждое обращение получает метку
+    max(виртуальное время, метка предыдущего того же класса) + 1/вес класса
+    и обслуживается в порядке меток. Внутри класса порядок FIFO, при
+    очереди из нескольких классов они получают слоты пропорционально
+    весам, поэтому классы с малым весом не простаивают. Для срочных
+    классов зарезервировано reserved_slots слотов отправки и каждого
+    канала, а переполнение очереди обычными обращениями их не отклоняет.
+
+    Место в очереди проверяется раз в position_interval секунд, а все
+    уведомления вместе ограничены position_rate в секунду, чтобы длинная
+    очередь не расходовала лимит Bot API, нужный для доставки.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 10,
+        max_queue: int = 500,
+        channel_limits: Optional[Dict[str, int]] = None,
+        position_interval: float = 5,
+        class_weights: Optional[Dict[str, int]] = None,
+        urgent_classes: Collection[str] = (),
+        reserved_slots: int = 0,
+        position_rate: float = 5,
+    ) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.position_interval = position_interval
+        self.position_rate = position_rate
+        self.position_tokens = position_rate
+        self.position_refilled_at = time.monotonic()
+        self.class_weights = class_weights or {DEFAULT_PRIORITY: 1}
+        self.urgent_classes = frozenset(urgent_classes)
+        self.reserved_slots = max(0, min(reserved_slots, max_concurrent - 1)) if self.urgent_classes else 0
+        self.active = 0
+        self.queues: Dict[str, Deque[Waiter]] = {}
+        self.last_tags: Dict[str, float] = {}
+        self.virtual_time = 0.0
+        self.channels: Dict[str, ChannelSlots] = {
+            name: ChannelSlots(limit, reserved_slots if self.urgent_classes else 0)
+            for name, limit in (channel_limits or {}).items()
+        }
+
+    @property
+    def waiters(self) -> list:
+        """Ожидающие обращения в порядке обслуживания"""
+        return sorted((waiter for queue in self.queues.values() for waiter in queue), key=lambda w: w.tag)
+
+    def queued(self, priority: Optional[str] = None) -> int:
+        if priority is not None:
+            return len(self.queues.get(priority, ()))
+        return sum(len(queue) for queue in self.queues.values())
+
+    def is_urgent(self, priority: str) -> bool:
+        return priority in self.urgent_classes
+
+    def _publish(self) -> None:
+        for priority, queue in self.queues.items():
+            admission_queue_gauge.set(len(queue), priority=priority)
+        admission_active_gauge.set(self.active)
+
+    def _has_capacity(self, priority: str) -> bool:
+        limit = self.max_concurrent
+        if not self.is_urgent(priority):
+            limit -= self.reserved_slots
+        return self.active < limit
+
+    def position(self, waiter: Waiter) -> int:
+        return 1 + sum(
+            1 for queue in self.queues.values() for other in queue if other.tag < waiter.tag
+        )
+
+    def _enqueue(self, priority: str) -> Waiter:
+        weight = self.class_weights.get(priority, 1)
+        tag = max(self.virtual_time, self.last_tags.get(priority, 0.0)) + 1 / weight
+        self.last_tags[priority] = tag
+        waiter = Waiter(asyncio.get_running_loop().create_future(), priority, tag)
+        self.queues.setdefault(priority, deque()).append(waiter)
+        return waiter
+
+    def _dispatch(self) -> None:
+        """Выдача свободных слотов ожидающим с наименьшей меткой"""
+        while True:
+            best = None
+            for priority, queue in self.queues.items():
+                if queue and self._has_capacity(priority) and (best is None or queue[0].tag < best.tag):
+                    best = queue[0]
+            if best is None:
+                break
+            self.queues[best.priority].popleft()
+            self.virtual_time = max(self.virtual_time, best.tag)
+            self.active += 1
+            best.future.set_result(None)
+
+    def _take_position_token(self) -> bool:
+        """Общий для всех ожидающих лимит уведомлений о месте в очереди"""
+        if not self.position_rate:
+            return True
+        now = time.monotonic()
+        self.position_tokens = min(
+            self.position_rate, self.position_tokens + (now - self.position_refilled_at) * self.position_rate
+        )
+        self.position_refilled_at = now
+        if self.position_tokens < 1:
+            return False
+        self.position_tokens -= 1
+        return True
+
+    async def _wait_turn(self, waiter: Waiter, on_position: Optional[PositionCallback]) -> None:
+        last_position = None
+        while True:
+            if on_position is not None:
+                position = self.position(waiter)
+                # Без свободного лимита уведомление откладывается до следующей проверки
+                if position != last_position and self._take_position_token():
+                    last_position = position
+                    try:
+                        await on_position(position)
+                    except Exception as e:
+                        logger.debug(f"Не удалось сообщить место в очереди: {e}")
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.position_interval)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    def _release(self) -> None:
+        self.active -= 1
+        self._dispatch()
+        self._publish()
+
+    @asynccontextmanager
+    async def admit(
+        self, on_position: Optional[PositionCallback] = None, priority: str = DEFAULT_PRIORITY
+    ) -> AsyncIterator[None]:
+        """Получение слота на отправку обращения"""
+        started = time.monotonic()
+
+        # Срочные обращения ограничены только собственной очередью
+        queued = self.queued(priority) if self.is_urgent(priority) else self.queued()
+        if queued >= self.max_queue:
+            admission_rejected_counter.inc(priority=priority)
+            raise AdmissionRejected()
+
+        waiter = self._enqueue(priority)
+        self._dispatch()
+        if not waiter.future.done():
+            self._publish()
+            try:
+                with span("admission_wait", priority=priority, position=self.position(waiter)):
+                    await self._wait_turn(waiter, on_position)
+            except BaseException:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # Слот уже выделен, возвращаем его
+                    self._release()
+                else:
+                    waiter.future.cancel()
+                    self.queues[priority].remove(waiter)
+                    self._publish()
+                raise
+
+        admission_wait_histogram.observe(time.monotonic() - started, priority=priority)
+        self._publish()
+        try:
+            yield
+        finally:
+            self._release()
+            delivery_latency_histogram.observe(time.monotonic() - started, priority=priority)
+
+    @asynccontextmanager
+    async def channel(self, name: str, priority: str = DEFAULT_PRIORITY) -> AsyncIterator[None]:
+        """Получение слота канала доставки"""
+        slots = self.channels.get(name)
+        if slots is None:
+            yield
+            return
+
+        started = time.monotonic()
+        with span(f"channel_wait.{name}"):
+            await slots.acquire(self.is_urgent(priority))
+        channel_wait_histogram.observe(time.monotonic() - started, channel=name, priority=priority)
+        try:
+            yield
+        finally:
+            slots.release()
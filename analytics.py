@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import time
+from collections import Counter, OrderedDict, defaultdict
+from datetime import datetime
+from typing import DefaultDict, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class P2Quantile:
+    """
+    Потоковая оценка квантиля алгоритмом P² (Jain & Chlamtac).
+
+    Хранит пять маркеров независимо от числа наблюдений, обновление O(1).
+    """
+
+    __slots__ = ("p", "count", "heights", "positions", "desired", "increments")
+
+    def __init__(self, p: float = 0.5) -> None:
+        self.p = p
+        self.count = 0
+        self.heights: List[float] = []
+        self.positions = [0, 1, 2, 3, 4]
+        self.desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        q = self.heights
+        if self.count <= 5:
+            q.append(value)
+            q.sort()
+            return
+
+        if value < q[0]:
+            q[0] = value
+            k = 0
+        elif value >= q[4]:
+            q[4] = value
+            k = 3
+        else:
+            k = 0
+            while value >= q[k + 1]:
+                k += 1
+
+        n = self.positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def _parabolic(self, i: int, d: int) -> float:
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    @property
+    def value(self) -> Optional[float]:
+        if not self.count:
+            return None
+        if self.count <= 5:
+            # Пока маркеры не заполнены, квантиль считается точно
+            return self.heights[min(int(self.p * self.count), self.count - 1)]
+        return self.heights[2]
+
+    def to_dict(self) -> Dict:
+        return {
+            "p": self.p, "count": self.count, "heights": list(self.heights),
+            "positions": list(self.positions), "desired": list(self.desired),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "P2Quantile":
+        sketch = cls(data["p"])
+        sketch.count = data["count"]
+        sketch.heights = data["heights"]
+        sketch.positions = data["positions"]
+        sketch.desired = data["desired"]
+        return sketch
+
+
+class Analytics:
+    """
+    Инкрементальная статистика обращений.
+
+    Счетчики обновляются при каждом переходе между состояниями и при
+    отправке обращения, поэтому отчет строится без просмотра истории:
+    - количество обращений по инстанциям и дням;
+    - медиана времени, проведенного на каждом шаге диалога;
+    - воронка: сколько сессий дошло до каждого шага.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_tracked: int = 50000) -> None:
+        self.path = path
+        self.max_tracked = max_tracked
+        self.daily: DefaultDict[str, Counter] = defaultdict(Counter)
+        self.totals: Counter = Counter()
+        self.funnel: Counter = Counter()
+        self.step_medians: Dict[str, P2Quantile] = {}
+        # Текущий шаг каждой сессии и время входа в него
+        self.current: "OrderedDict[Hashable, Tuple[str, float]]" = OrderedDict()
+
+    def on_state_change(
+        self, key: Hashable, old_state: Optional[str], new_state: Optional[str], now: Optional[float] = None
+    ) -> None:
+        if old_state == new_state:
+            return
+        if now is None:
+            now = time.monotonic()
+
+        entered = self.current.pop(key, None)
+        if entered is not None:
+            state, entered_at = entered
+            sketch = self.step_medians.get(state)
+            if sketch is None:
+                sketch = self.step_medians[state] = P2Quantile(0.5)
+            sketch.add(now - entered_at)
+
+        if new_state is not None:
+            self.funnel[new_state] += 1
+            self.current[key] = (new_state, now)
+            if len(self.current) > self.max_tracked:
+                self.current.popitem(last=False)
+
+    def forget(self, key: Hashable) -> None:
+        """Сессия удалена без перехода (истекла или вытеснена)"""
+        self.current.pop(key, None)
+
+    def on_submitted(self, instance: str, created_at: datetime) -> None:
+        self.daily[created_at.date().isoformat()][instance] += 1
+        self.totals[instance] += 1
+        self.funnel["submitted"] += 1
+
+    def today(self, day: Optional[str] = None) -> Counter:
+        return self.daily.get(day or datetime.now().date().isoformat(), Counter())
+
+    def median(self, state: str) -> Optional[float]:
+        sketch = self.step_medians.get(state)
+        return sketch.value if sketch else None
+
+    def conversion(self, from_state: str, to_state: str) -> Optional[float]:
+        """Доля сессий, дошедших от одного шага до другого"""
+        started = self.funnel.get(from_state, 0)
+        if not started:
+            return None
+        return self.funnel.get(to_state, 0) / started
+
+    def to_dict(self) -> Dict:
+        """Снимок статистики, не разделяющий изменяемых данных с объектом"""
+        return {
+            "daily": {day: dict(counts) for day, counts in self.daily.items()},
+            "totals": dict(self.totals),
+            "funnel": dict(self.funnel),
+            "step_medians": {state: sketch.to_dict() for state, sketch in self.step_medians.items()},
+        }
+
+    def save(self, snapshot: Optional[Dict] = None) -> None:
+        """
+        Сохранение снимка статистики.
+
+        Для записи в отдельном потоке снимок нужно снять заранее в потоке
+        бота (to_dict), пока счетчики не изменяются обработчиками.
+        """
+        if not self.path:
+            return
+        if snapshot is None:
+            snapshot = self.to_dict()
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Ошибка сохранения статистики: {e}")
+
+    def load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка чтения статистики {self.path}: {e}")
+            return
+
+        for day, counts in data.get("daily", {}).items():
+            self.daily[day].update(counts)
+        self.totals.update(data.get("totals", {}))
+        self.funnel.update(data.get("funnel", {}))
+        self.step_medians.update({
+            state: P2Quantile.from_dict(sketch) for state, sketch in data.get("step_medians", {}).items()
+        })
@@ -0,0 +1,203 @@
+import base64
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS appeals (
+    appeal_id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    topic TEXT NOT NULL,
+    text TEXT NOT NULL,
+    full_name TEXT NOT NULL,
+    contact_method TEXT NOT NULL,
+    chat_id INTEGER,
+    attachments TEXT NOT NULL DEFAULT '[]',
+    stored_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS appeals_created ON appeals (created_at, appeal_id);
+CREATE INDEX IF NOT EXISTS appeals_instance_created ON appeals (instance, created_at, appeal_id);
+"""
+
+COLUMNS = (
+    "appeal_id", "created_at", "instance", "topic", "text",
+    "full_name", "contact_method", "chat_id", "attachments",
+)
+
+
+def encode_cursor(created_at: str, appeal_id: str) -> str:
+    raw = json.dumps([created_at, appeal_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    """Разбор курсора пагинации, ValueError при некорректном значении"""
+    try:
+        created_at, appeal_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception as e:
+        raise ValueError(f"Некорректный курсор: {cursor}") from e
+    return str(created_at), str(appeal_id)
+
+
+class AppealStore:
+    """
+    Хранилище отправленных обращений в SQLite.
+
+    Выборки используют keyset-пагинацию по (created_at, appeal_id), поэтому
+    стоимость страницы не зависит от ее номера. Каждая операция открывает
+    собственное соединение, так что хранилище можно использовать из
+    разных потоков и процессов (бот и панель оператора). Файл базы и
+    схема создаются при первой операции, а не при создании хранилища.
+
+    read_only — для панели оператора и выгрузки: база открывается только
+    на чтение и должна уже существовать, иначе FileNotFoundError (чтобы
+    неверный путь не создавал пустую базу).
+    """
+
+    def __init__(self, path: str, read_only: bool = False) -> None:
+        self.path = path
+        self.read_only = read_only
+        self.initialized = read_only
+        if read_only and not os.path.isfile(path):
+            raise FileNotFoundError(f"База обращений не найдена: {path}")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        if self.read_only:
+            conn = sqlite3.connect(f"{Path(self.path).absolute().as_uri()}?mode=ro", uri=True, timeout=10)
+        else:
+            conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            if not self.initialized:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(SCHEMA)
+                self.initialized = True
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def save(self, appeal: Dict) -> None:
+        """Сохранение обращения (словарь из Appeal.to_dict())"""
+        attachments = list(appeal.get("media_files") or []) + list(appeal.get("doc_files") or [])
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO appeals "
+                "(appeal_id, created_at, instance, topic, text, full_name, contact_method, "
+                "chat_id, attachments, stored_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    appeal["appeal_id"], appeal["created_at"], appeal["instance"],
+                    appeal["topic"], appeal["text"], appeal["full_name"],
+                    appeal["contact_method"], appeal.get("chat_id"),
+                    json.dumps(attachments, ensure_ascii=False), time.time(),
+                ),
+            )
+
+    @staticmethod
+    def _row_to_dict(row: sqlite3.Row) -> Dict:
+        item = {name: row[name] for name in COLUMNS}
+        item["attachments"] = json.loads(item["attachments"])
+        return item
+
+    @staticmethod
+    def _filters(
+        instance: Optional[str], date_from: Optional[date], date_to: Optional[date]
+    ) -> Tuple[List[str], List]:
+        where, params = [], []
+        if instance:
+            where.append("instance = ?")
+            params.append(instance)
+        if date_from:
+            where.append("created_at >= ?")
+            params.append(date_from.isoformat())
+        if date_to:
+            # Дата окончания включается в выборку целиком
+            where.append("created_at < ?")
+            params.append((date_to + timedelta(days=1)).isoformat())
+        return where, params
+
+    def get(self, appeal_id: str) -> Optional[Dict]:
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM appeals WHERE appeal_id = ?", (appeal_id,)
+            ).fetchone()
+        return self._row_to_dict(row) if row else None
+
+    def list(
+        self,
+        instance: Optional[str] = None,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        cursor: Optional[str] = None,
+        limit: int = 50,
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """Страница обращений от новых к старым и курсор следующей страницы"""
+        where, params = self._filters(instance, date_from, date_to)
+        if cursor:
+            where.append("(created_at, appeal_id) < (?, ?)")
+            params.extend(decode_cursor(cursor))
+
+        query = f"SELECT {', '.join(COLUMNS)} FROM appeals"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY created_at DESC, appeal_id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        with self._connect() as conn:
+            rows = conn.execute(query, params).fetchall()
+
+        items = [self._row_to_dict(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = items[-1]
+            next_cursor = encode_cursor(last["created_at"], last["appeal_id"])
+        return items, next_cursor
+
+    def iter_appeals(
+        self,
+        instance: Optional[str] = None,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        batch_size: int = 500,
+    ) -> Iterator[Dict]:
+        """Потоковый обход обращений от старых к новым"""
+        where, params = self._filters(instance, date_from, date_to)
+        query = f"SELECT {', '.join(COLUMNS)} FROM appeals"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY created_at, appeal_id"
+
+        with self._connect() as conn:
+            result = conn.execute(query, params)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield self._row_to_dict(row)
+
+    def instances(self) -> List[str]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT DISTINCT instance FROM appeals ORDER BY instance").fetchall()
+        return [row[0] for row in rows]
+
+    def version(self) -> Tuple[int, float]:
+        """
+        Версия данных: rowid и время сохранения последней записи.
+
+        Каждая запись (в том числе перезапись) получает новый rowid,
+        поэтому версия меняется при любом изменении; запрос выполняется
+        по первичному ключу за O(log n).
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT rowid, stored_at FROM appeals ORDER BY rowid DESC LIMIT 1"
+            ).fetchone()
+        return (row[0], row[1]) if row else (0, 0.0)
@@ -0,0 +1,106 @@
+"""
+Замер памяти на незавершенные обращения с помощью tracemalloc.
+
+Сравнивает прежнее представление (вложения словарями, обычный dataclass)
+с текущим (кортежи в данных FSM, Attachment и Appeal со slots):
+
+    python bench_memory.py --drafts 10000
+
+Как и тесты, требует файла .env с BOT_TOKEN и OPERATOR_ID.
+"""
+import argparse
+import gc
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from bot import Appeal, Attachment
+
+ATTACHMENTS_PER_DRAFT = 3
+
+
+@dataclass
+class LegacyAppeal:
+    """Обращение в прежнем виде, для сравнения"""
+    instance: str
+    topic: str
+    text: str
+    full_name: str
+    contact_method: str
+    media_files: List[Dict] = None
+    doc_files: List[Dict] = None
+    created_at: datetime = None
+    chat_id: Optional[int] = None
+    appeal_id: str = None
+
+
+def make_files(i: int) -> List[Attachment]:
+    return [
+        Attachment('photo', f"AgACAgIAAxkBAAI{i:08d}{n}", f"photo_{n + 1}.jpg", 250_000)
+        for n in range(ATTACHMENTS_PER_DRAFT)
+    ]
+
+
+def make_fields(i: int) -> Dict:
+    return dict(
+        instance="Организация питания",
+        topic=f"Тема обращения {i}",
+        text=f"Текст обращения {i} " * 20,
+        full_name=f"Иванов Иван {i}",
+        contact_method=f"student{i}@example.com",
+    )
+
+
+def legacy_draft(i: int) -> Dict:
+    return {**make_fields(i), 'media_files': [file.to_dict() for file in make_files(i)], 'doc_files': []}
+
+
+def compact_draft(i: int) -> Dict:
+    return {**make_fields(i), 'media_files': [file.to_tuple() for file in make_files(i)], 'doc_files': []}
+
+
+def legacy_appeal(i: int) -> LegacyAppeal:
+    return LegacyAppeal(
+        **make_fields(i), media_files=[file.to_dict() for file in make_files(i)], doc_files=[],
+        created_at=datetime.now(), chat_id=i, appeal_id=f"{i:032x}"
+    )
+
+
+def compact_appeal(i: int) -> Appeal:
+    return Appeal(
+        **make_fields(i), media_files=make_files(i), doc_files=[],
+        created_at=datetime.now(), chat_id=i, appeal_id=f"{i:032x}"
+    )
+
+
+def measure(factory: Callable[[int], object], count: int) -> float:
+    """Байт на одну запись"""
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    items = [factory(i) for i in range(count)]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return (after - before) / count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Память на незавершенные обращения")
+    parser.add_argument("--drafts", type=int, default=10000, help="количество обращений")
+    args = parser.parse_args()
+
+    print(f"Обращений: {args.drafts}, вложений в каждом: {ATTACHMENTS_PER_DRAFT}")
+    print(f"{'':<22}{'было, Б':>12}{'стало, Б':>12}{'экономия':>10}")
+    for name, legacy, compact in (
+        ("Черновик в FSM", legacy_draft, compact_draft),
+        ("Отправляемое Appeal", legacy_appeal, compact_appeal),
+    ):
+        before = measure(legacy, args.drafts)
+        after = measure(compact, args.drafts)
+        print(f"{name:<22}{before:>12.0f}{after:>12.0f}{1 - after / before:>10.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,21 +6,39 @@ from datetime import datetime
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
-from email import encoders
-from typing import Dict, List, Optional
+from typing import BinaryIO, Deque, Dict, List, Optional, Tuple
 from dataclasses import dataclass
 from logging.handlers import RotatingFileHandler
+import tempfile
 import textwrap
+import uuid
+from collections import deque
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.utils.media_group import MediaGroupBuilder
 from dotenv_vault import load_dotenv
 
+from admission import DEFAULT_PRIORITY, AdmissionController, AdmissionRejected, parse_priorities, parse_weights
+from analytics import Analytics
+from appeal_store import AppealStore
+from bot_session import TunedAiohttpSession, parse_timeouts
+from circuit_breaker import CircuitBreaker, CircuitState
+from idempotency import SubmissionGuard, duplicate_submissions_counter
+from local_files import encode_base64_file, encode_base64_stream, local_api_server, media_size_limit
+from mail_stream import MessageSpool, send_message_file
+from metrics import REGISTRY, start_metrics_server
+from reply_index import ReplyIndex
+from session_storage import BoundedMemoryStorage
+from shutdown import Delivery, DeliveryTracker, UpdateOffsetMiddleware, load_pending, save_pending
+from throttling import ThrottlingMiddleware, parse_limit, parse_limits
+from tracing import TracingMiddleware, bind_trace, finish_trace, record_error, span, traced, tracer
+
 # Загрузка переменных окружения
 load_dotenv("~/KMB-hotline/.env")
 
@@ -46,11 +64,206 @@ SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
 CORPORATE_EMAIL = os.getenv("CORPORATE_EMAIL")
 
+# Ограничения хранилища сессий
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "10000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_IDLE_TIMEOUT = int(os.getenv("SESSION_IDLE_TIMEOUT", str(24 * 60 * 60)))
+SESSION_REAP_INTERVAL = int(os.getenv("SESSION_REAP_INTERVAL", "300"))
+SESSION_EXPIRE_NOTICE = os.getenv("SESSION_EXPIRE_NOTICE", "true").lower() in ("1", "true", "yes")
+
+# Ограничение частоты запросов от пользователя («событий/секунд»)
+THROTTLE_DEFAULT = parse_limit(os.getenv("THROTTLE_DEFAULT", "30/60"))
+THROTTLE_LIMITS = {
+    'receive_media': (20, 60.0),    # Не больше двух полных альбомов в минуту
+    'receive_text': (5, 60.0),
+    'unknown_message': (5, 60.0),
+    'operator_reply': (120, 60.0),
+    **parse_limits(os.getenv("THROTTLE_LIMITS", ""))
+}
+
+# Автоматические выключатели каналов доставки
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "15"))
+# Письма крупнее собираются во временном файле на диске
+EMAIL_SPOOL_MEMORY = int(os.getenv("EMAIL_SPOOL_MEMORY", str(1024 * 1024)))
+SMTP_FAILURE_THRESHOLD = int(os.getenv("SMTP_FAILURE_THRESHOLD", "3"))
+SMTP_RECOVERY_TIMEOUT = int(os.getenv("SMTP_RECOVERY_TIMEOUT", "120"))
+TELEGRAM_FAILURE_THRESHOLD = int(os.getenv("TELEGRAM_FAILURE_THRESHOLD", "5"))
+TELEGRAM_RECOVERY_TIMEOUT = int(os.getenv("TELEGRAM_RECOVERY_TIMEOUT", "30"))
+PARKED_RETRY_INTERVAL = int(os.getenv("PARKED_RETRY_INTERVAL", "30"))
+PARKED_MAX_APPEALS = int(os.getenv("PARKED_MAX_APPEALS", "1000"))
+PARKED_MAX_ATTEMPTS = int(os.getenv("PARKED_MAX_ATTEMPTS", "5"))
+
+# Ограничение одновременной отправки обращений
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "10"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "500"))
+ADMISSION_POSITION_RATE = float(os.getenv("ADMISSION_POSITION_RATE", "5"))
+SMTP_MAX_CONNECTIONS = int(os.getenv("SMTP_MAX_CONNECTIONS", "3"))
+TELEGRAM_MAX_DELIVERIES = int(os.getenv("TELEGRAM_MAX_DELIVERIES", "5"))
+
+# Классы приоритета: вес в очереди на отправку и инстанции каждого класса
+URGENT_PRIORITY = 'urgent'
+PRIORITY_WEIGHTS = {
+    URGENT_PRIORITY: 4,
+    DEFAULT_PRIORITY: 1,
+    **parse_weights(os.getenv("PRIORITY_WEIGHTS", ""))
+}
+INSTANCE_PRIORITIES = {
+    "Нарушение прав обучающихся": URGENT_PRIORITY,
+    "Обращение по фактам коррупции": URGENT_PRIORITY,
+    **parse_priorities(os.getenv("INSTANCE_PRIORITIES", ""))
+}
+URGENT_RESERVED_SLOTS = int(os.getenv("URGENT_RESERVED_SLOTS", "1"))
+
+# Защита от повторной отправки (двойное нажатие, повтор колбэка)
+SUBMISSION_DEDUPE_TTL = int(os.getenv("SUBMISSION_DEDUPE_TTL", "600"))
+
+# Хранилище отправленных обращений (читается панелью оператора dashboard.py)
+APPEALS_DB = os.getenv("APPEALS_DB", "appeals.db")
+
+# Статистика обращений
+ANALYTICS_FILE = os.getenv("ANALYTICS_FILE", "analytics.json")
+ANALYTICS_SNAPSHOT_INTERVAL = int(os.getenv("ANALYTICS_SNAPSHOT_INTERVAL", "300"))
+
+# Индекс ответов оператора
+REPLY_INDEX_FILE = os.getenv("REPLY_INDEX_FILE", "reply_index.jsonl")
+REPLY_INDEX_MAX_ENTRIES = int(os.getenv("REPLY_INDEX_MAX_ENTRIES", "50000"))
+REPLY_INDEX_TTL_DAYS = int(os.getenv("REPLY_INDEX_TTL_DAYS", "90"))
+
+# Корректная остановка
+SHUTDOWN_TIMEOUT = int(os.getenv("SHUTDOWN_TIMEOUT", "30"))
+PENDING_APPEALS_FILE = os.getenv("PENDING_APPEALS_FILE", "pending_appeals.json")
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "false").lower() in ("1", "true", "yes")
+
+# HTTP-эндпоинт мониторинга (/metrics, /health), отключен если порт не задан
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Соединения с Bot API
+BOT_API_POOL_LIMIT = int(os.getenv("BOT_API_POOL_LIMIT", "100"))
+BOT_API_POOL_LIMIT_PER_HOST = int(os.getenv("BOT_API_POOL_LIMIT_PER_HOST", "0"))
+BOT_API_KEEPALIVE_TIMEOUT = float(os.getenv("BOT_API_KEEPALIVE_TIMEOUT", "30"))
+BOT_API_DNS_CACHE_TTL = int(os.getenv("BOT_API_DNS_CACHE_TTL", "300"))
+BOT_API_TIMEOUT = float(os.getenv("BOT_API_TIMEOUT", "60"))
+BOT_API_METHOD_TIMEOUTS = {
+    'getFile': 10,
+    'editMessageText': 10,
+    'sendMessage': 15,
+    'sendMediaGroup': 60,
+    **parse_timeouts(os.getenv("BOT_API_METHOD_TIMEOUTS", ""))
+}
+BOT_API_RETRIES = int(os.getenv("BOT_API_RETRIES", "3"))
+
+# Собственный сервер Bot API в режиме --local: файлы читаются с диска
+BOT_API_SERVER_URL = os.getenv("BOT_API_SERVER_URL", "")
+BOT_API_LOCAL_FILES = os.getenv("BOT_API_LOCAL_FILES", "")    # «путь_на_сервере:путь_у_бота»
+MAX_MEDIA_SIZE = media_size_limit(int(os.getenv("MAX_MEDIA_SIZE", "0")), is_local=bool(BOT_API_SERVER_URL))
+
+# Трассировка обращений: медленные и неудачные записываются всегда, остальные выборочно
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_SLOW_THRESHOLD = float(os.getenv("TRACE_SLOW_THRESHOLD", "5"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_MAX_ACTIVE = int(os.getenv("TRACE_MAX_ACTIVE", "10000"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(50 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = int(os.getenv("TRACE_BACKUP_COUNT", "3"))
+
 # Инициализация бота
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+session = TunedAiohttpSession(
+    limit=BOT_API_POOL_LIMIT,
+    limit_per_host=BOT_API_POOL_LIMIT_PER_HOST,
+    keepalive_timeout=BOT_API_KEEPALIVE_TIMEOUT,
+    ttl_dns_cache=BOT_API_DNS_CACHE_TTL,
+    timeout=BOT_API_TIMEOUT,
+    method_timeouts=BOT_API_METHOD_TIMEOUTS,
+    retry_attempts=BOT_API_RETRIES
+)
+if BOT_API_SERVER_URL:
+    session.api = local_api_server(BOT_API_SERVER_URL, BOT_API_LOCAL_FILES)
+bot = Bot(token=BOT_TOKEN, session=session)
+analytics = Analytics(path=ANALYTICS_FILE)
+storage = BoundedMemoryStorage(
+    max_entries=SESSION_MAX_ENTRIES,
+    max_bytes=SESSION_MAX_BYTES,
+    idle_timeout=SESSION_IDLE_TIMEOUT,
+    on_state_change=analytics.on_state_change
+)
+REGISTRY.callback_gauge("hotline_sessions", "Незавершенные диалоги по состояниям", ["state"], storage.state_counts)
+REGISTRY.register_health('sessions', storage.health)
 dp = Dispatcher(storage=storage)
 
+throttling = ThrottlingMiddleware(default_limit=THROTTLE_DEFAULT, limits=THROTTLE_LIMITS)
+dp.message.middleware(throttling)
+dp.callback_query.middleware(throttling)
+
+tracer.configure(
+    path=TRACE_FILE,
+    slow_threshold=TRACE_SLOW_THRESHOLD,
+    sample_rate=TRACE_SAMPLE_RATE,
+    max_traces=TRACE_MAX_ACTIVE,
+    max_bytes=TRACE_MAX_BYTES,
+    backup_count=TRACE_BACKUP_COUNT
+)
+tracing = TracingMiddleware(trace_key='draft_id')
+dp.message.middleware(tracing)
+dp.callback_query.middleware(tracing)
+
+update_offsets = UpdateOffsetMiddleware()
+dp.update.outer_middleware(update_offsets)
+delivery_tracker = DeliveryTracker()
+appeal_store = AppealStore(APPEALS_DB)
+reply_index = ReplyIndex(
+    path=REPLY_INDEX_FILE,
+    max_entries=REPLY_INDEX_MAX_ENTRIES,
+    ttl=REPLY_INDEX_TTL_DAYS * 24 * 60 * 60
+)
+admission = AdmissionController(
+    max_concurrent=ADMISSION_MAX_CONCURRENT,
+    max_queue=ADMISSION_MAX_QUEUE,
+    position_rate=ADMISSION_POSITION_RATE,
+    channel_limits={'smtp': SMTP_MAX_CONNECTIONS, 'telegram': TELEGRAM_MAX_DELIVERIES},
+    class_weights=PRIORITY_WEIGHTS,
+    urgent_classes={URGENT_PRIORITY},
+    reserved_slots=URGENT_RESERVED_SLOTS
+)
+submissions = SubmissionGuard(ttl=SUBMISSION_DEDUPE_TTL)
+
+smtp_breaker = CircuitBreaker(
+    "smtp",
+    failure_threshold=SMTP_FAILURE_THRESHOLD,
+    recovery_timeout=SMTP_RECOVERY_TIMEOUT
+)
+telegram_breaker = CircuitBreaker(
+    "telegram",
+    failure_threshold=TELEGRAM_FAILURE_THRESHOLD,
+    recovery_timeout=TELEGRAM_RECOVERY_TIMEOUT
+)
+
+# Обращения, отложенные до восстановления канала
+parked_appeals: Dict[str, Deque["Appeal"]] = {
+    'smtp': deque(),
+    'telegram': deque()
+}
+# Неудачные попытки повторной доставки по (каналу, обращению) и обращения,
+# исчерпавшие попытки: их не принимает сам канал (содержимое, размер),
+# поэтому они не должны задерживать остальные отложенные обращения
+parked_attempts: Dict[Tuple[str, str], int] = {}
+dead_letter_appeals: Dict[str, Deque["Appeal"]] = {
+    'smtp': deque(maxlen=PARKED_MAX_APPEALS),
+    'telegram': deque(maxlen=PARKED_MAX_APPEALS)
+}
+dead_letter_counter = REGISTRY.counter(
+    "hotline_dead_letter_appeals_total", "Обращения, исчерпавшие попытки повторной доставки", ["channel"]
+)
+
+def channel_health(breaker: CircuitBreaker):
+    return lambda: {
+        **breaker.health(),
+        'parked': len(parked_appeals[breaker.name]),
+        'dead_letter': len(dead_letter_appeals[breaker.name])
+    }
+
+REGISTRY.register_health('smtp', channel_health(smtp_breaker))
+REGISTRY.register_health('telegram', channel_health(telegram_breaker))
+
 # Состояния FSM
 class AppealStates(StatesGroup):
     waiting_for_agreement = State()
@@ -62,25 +275,77 @@ class AppealStates(StatesGroup):
     entering_contact_method = State()
     confirming_appeal = State()
 
+# Вложение обращения
+@dataclass(slots=True)
+class Attachment:
+    type: str
+    file_id: str
+    file_name: str
+    file_size: int
+    
+    def to_tuple(self) -> tuple:
+        """Компактное представление для данных FSM"""
+        return (self.type, self.file_id, self.file_name, self.file_size)
+    
+    def to_dict(self) -> Dict:
+        return {
+            'type': self.type,
+            'file_id': self.file_id,
+            'file_name': self.file_name,
+            'file_size': self.file_size
+        }
+    
+    @classmethod
+    def from_value(cls, value) -> "Attachment":
+        """Вложение из кортежа FSM, словаря или готового объекта"""
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, dict):
+            return cls(**value)
+        return cls(*value)
+
+def load_attachments(values) -> List[Attachment]:
+    return [Attachment.from_value(value) for value in values or ()]
+
 # Структура обращения
-@dataclass
+@dataclass(slots=True)
 class Appeal:
     instance: str
     topic: str
     text: str
     full_name: str
     contact_method: str
-    media_files: List[Dict] = None
-    doc_files: List[Dict] = None
+    media_files: List[Attachment] = None
+    doc_files: List[Attachment] = None
     created_at: datetime = None
+    chat_id: Optional[int] = None
+    appeal_id: str = None
     
     def __post_init__(self):
-        if self.media_files is None:
-            self.media_files = []
-        if self.doc_files is None:
-            self.doc_files = []
+        self.media_files = load_attachments(self.media_files)
+        self.doc_files = load_attachments(self.doc_files)
         if self.created_at is None:
             self.created_at = datetime.now()
+        if self.appeal_id is None:
+            self.appeal_id = uuid.uuid4().hex
+    
+    def to_dict(self) -> Dict:
+        return {
+            'instance': self.instance,
+            'topic': self.topic,
+            'text': self.text,
+            'full_name': self.full_name,
+            'contact_method': self.contact_method,
+            'media_files': [file.to_dict() for file in self.media_files],
+            'doc_files': [file.to_dict() for file in self.doc_files],
+            'created_at': self.created_at.isoformat(),
+            'chat_id': self.chat_id,
+            'appeal_id': self.appeal_id
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Appeal":
+        return cls(**{**data, 'created_at': datetime.fromisoformat(data['created_at'])})
 
 # Функция для экранирования символов MarkdownV2
 """
@@ -155,9 +420,12 @@ def get_skip_media_keyboard():
     ])
     return keyboard
 
-def get_confirm_keyboard():
+def get_confirm_keyboard(draft_id: Optional[str] = None):
+    # Ключ черновика в данных кнопки позволяет распознать повтор колбэка
+    # даже после очистки состояния
+    send_data = f"send_appeal:{draft_id}" if draft_id else "send_appeal"
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📤 Отправить обращение", callback_data="send_appeal")],
+        [InlineKeyboardButton(text="📤 Отправить обращение", callback_data=send_data)],
         [InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_appeal")]
     ])
     return keyboard
@@ -177,9 +445,81 @@ def format_file_size(size_bytes: int) -> str:
     else:
         return f"{size_bytes/(1024**2):.1f} MB"
 
+def appeal_priority(appeal: Appeal) -> str:
+    """Класс приоритета обращения по инстанции"""
+    return INSTANCE_PRIORITIES.get(appeal.instance, DEFAULT_PRIORITY)
+
+# Ошибки недоступности канала: сеть, таймауты, 5xx и ограничения частоты.
+# Остальные ошибки вызваны конкретным обращением (разметка текста,
+# устаревший file_id, слишком большое письмо) и не должны открывать канал
+TELEGRAM_CHANNEL_ERRORS = (TelegramNetworkError, TelegramServerError, TelegramRetryAfter, OSError, asyncio.TimeoutError)
+
+def is_telegram_channel_error(error: BaseException) -> bool:
+    return isinstance(error, TELEGRAM_CHANNEL_ERRORS)
+
+def is_smtp_channel_error(error: BaseException) -> bool:
+    if isinstance(error, (smtplib.SMTPConnectError, smtplib.SMTPHeloError, smtplib.SMTPAuthenticationError)):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        # 4xx — временный отказ сервера, 5xx — отказ принять это письмо
+        return error.smtp_code < 500
+    # SMTPException наследует OSError: сюда попадают разрывы соединения и таймауты
+    return isinstance(error, OSError)
+
 # Функция отправки email
-async def send_email(appeal: Appeal) -> bool:
+def park_appeal(channel: str, appeal: Appeal) -> None:
+    """Откладывание обращения до восстановления канала"""
+    queue = parked_appeals[channel]
+    if len(queue) >= PARKED_MAX_APPEALS:
+        logger.error(f"Очередь отложенных обращений {channel} переполнена, обращение не сохранено: {appeal.topic}")
+        return
+    queue.append(appeal)
+    logger.warning(f"Канал {channel} недоступен, обращение отложено: {appeal.topic}")
+
+@traced("attachment")
+async def write_attachment(message: MessageSpool, file: Attachment) -> None:
+    """Вложение письма с содержимым файла из Telegram"""
+    file_info = await bot.get_file(file.file_id)
+    part = MIMEBase('application', 'octet-stream')
+    part['Content-Transfer-Encoding'] = 'base64'
+    part.add_header(
+        'Content-Disposition',
+        f'attachment; filename= {file.file_name}'
+    )
+    api = bot.session.api
+    if api.is_local:
+        # Локальный сервер Bot API возвращает путь к файлу на диске
+        path = api.wrap_local_file.to_local(file_info.file_path)
+        with span("encode_local_file"), message.attachment(part) as out:
+            await asyncio.to_thread(encode_base64_file, path, out)
+        return
+
+    with tempfile.SpooledTemporaryFile(max_size=EMAIL_SPOOL_MEMORY) as data:
+        with span("download_file"):
+            await bot.download_file(file_info.file_path, destination=data)
+        with message.attachment(part) as out:
+            await asyncio.to_thread(encode_base64_stream, data, out)
+
+def deliver_email(message: BinaryIO) -> None:
+    """SMTP-сессия; таймаут соединения считается сбоем канала"""
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+    try:
+        server.starttls()
+        server.login(SMTP_USER, SMTP_PASSWORD)
+        send_message_file(server, SMTP_USER, CORPORATE_EMAIL, message)
+        server.quit()
+    except Exception:
+        server.close()
+        raise
+
+@traced("send_email")
+async def send_email(appeal: Appeal, park: bool = True) -> bool:
     """Отправка обращения на корпоративную почту"""
+    if not smtp_breaker.allow_request():
+        if park:
+            park_appeal('smtp', appeal)
+        return False
+
     try:
         msg = MIMEMultipart()
         msg['From'] = SMTP_USER
@@ -204,58 +544,44 @@ async def send_email(appeal: Appeal) -> bool:
 Отправлено через Telegram-бот "Горячая линия обращений студентов"
         """
         
-        msg.attach(MIMEText(body, 'plain', 'utf-8'))
-        
-        # Прикрепление медиа-файлов
-        for media_file in appeal.media_files:
-            for doc_file in appeal.doc_files:
+        # Письмо собирается во временном файле: вложения кодируются в него
+        # по частям и не копируются в память целиком
+        with MessageSpool(msg, max_size=EMAIL_SPOOL_MEMORY) as message:
+            message.add(MIMEText(body, 'plain', 'utf-8'))
+            
+            # Прикрепление медиа-файлов и документов
+            for file in appeal.media_files + appeal.doc_files:
                 try:
-                    file_info = await bot.get_file(doc_file['file_id'])
-                    file_data = await bot.download_file(file_info.file_path)
-                    
-                    part = MIMEBase('application', 'octet-stream')
-                    part.set_payload(file_data.read())
-                    encoders.encode_base64(part)
-                    part.add_header(
-                        'Content-Disposition',
-                        f'attachment; filename= {doc_file["file_name"]}'
-                    )
-                    msg.attach(part)
+                    await write_attachment(message, file)
                 except Exception as e:
-                    logger.error(f"Ошибка прикрепления файла {doc_file['file_name']}: {e}")
-            try:
-                file_info = await bot.get_file(media_file['file_id'])
-                file_data = await bot.download_file(file_info.file_path)
-                
-                part = MIMEBase('application', 'octet-stream')
-                part.set_payload(file_data.read())
-                encoders.encode_base64(part)
-                part.add_header(
-                    'Content-Disposition',
-                    f'attachment; filename= {media_file["file_name"]}'
-                )
-                msg.attach(part)
-            except Exception as e:
-                logger.error(f"Ошибка прикрепления файла {media_file['file_name']}: {e}")
-        
-        # Отправка письма
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(SMTP_USER, SMTP_PASSWORD)
-        text = msg.as_string()
-        server.sendmail(SMTP_USER, CORPORATE_EMAIL, text)
-        server.quit()
+                    logger.error(f"Ошибка прикрепления файла {file.file_name}: {e}")
+            
+            # Отправка письма (в отдельном потоке, чтобы не блокировать бота)
+            with span("smtp"):
+                await asyncio.to_thread(deliver_email, message.finish())
         
+        smtp_breaker.record_success()
         logger.info(f"Email отправлен для обращения: {appeal.topic}")
         return True
         
     except Exception as e:
         logger.error(f"Ошибка отправки email: {e}")
+        record_error(e)
+        if is_smtp_channel_error(e):
+            smtp_breaker.record_failure(e)
+            if park and smtp_breaker.is_open:
+                park_appeal('smtp', appeal)
         return False
 
 # Функция отправки обращения оператору
-async def send_to_operator(appeal: Appeal) -> bool:
+@traced("send_to_operator")
+async def send_to_operator(appeal: Appeal, park: bool = True) -> bool:
     """Отправка обращения оператору в Telegram"""
+    if not telegram_breaker.allow_request():
+        if park:
+            park_appeal('telegram', appeal)
+        return False
+
     try:
         # Формирование сообщения для оператора
         operator_message = f"""
@@ -278,76 +604,218 @@ async def send_to_operator(appeal: Appeal) -> bool:
             text=operator_message,
             parse_mode='HTML'
         )
+        sent_messages = [sent_message]
         
         # Отправка медиа-файлов, если есть
         if appeal.media_files:
             if len(appeal.media_files) == 1:
                 # Один файл
                 media_file = appeal.media_files[0]
-                if media_file['type'] == 'photo':
-                    await bot.send_photo(
+                if media_file.type == 'photo':
+                    sent_messages.append(await bot.send_photo(
                         chat_id=OPERATOR_ID,
-                        photo=media_file['file_id'],
+                        photo=media_file.file_id,
                         caption=f"📎 Вложение к обращению: {appeal.topic}"
-                    )
-                elif media_file['type'] == 'document':
-                    await bot.send_document(
+                    ))
+                elif media_file.type == 'document':
+                    sent_messages.append(await bot.send_document(
                         chat_id=OPERATOR_ID,
-                        document=media_file['file_id'],
+                        document=media_file.file_id,
                         caption=f"📎 Вложение к обращению: {appeal.topic}"
-                    )
+                    ))
             else:
                 # Группа файлов
                 media_group = MediaGroupBuilder(caption=f"📎 Вложения к обращению: {appeal.topic}")
                 
                 for media_file in appeal.media_files:
-                    if media_file['type'] == 'photo':
-                        media_group.add_photo(media=media_file['file_id'])
-                    elif media_file['type'] == 'document':
-                        media_group.add_document(media=media_file['file_id'])
+                    if media_file.type == 'photo':
+                        media_group.add_photo(media=media_file.file_id)
+                    elif media_file.type == 'document':
+                        media_group.add_document(media=media_file.file_id)
                 
-                await bot.send_media_group(
+                sent_messages.extend(await bot.send_media_group(
                     chat_id=OPERATOR_ID,
                     media=media_group.build()
-                )
+                ))
 
         if appeal.doc_files:
             if len(appeal.doc_files) == 1:
                 # Один файл
                 doc_file = appeal.doc_files[0]
-                if doc_file['type'] == 'photo':
-                    await bot.send_photo(
+                if doc_file.type == 'photo':
+                    sent_messages.append(await bot.send_photo(
                         chat_id=OPERATOR_ID,
-                        photo=doc_file['file_id'],
+                        photo=doc_file.file_id,
                         caption=f"📎 Вложение к обращению: {appeal.topic}"
-                    )
-                elif doc_file['type'] == 'document':
-                    await bot.send_document(
+                    ))
+                elif doc_file.type == 'document':
+                    sent_messages.append(await bot.send_document(
                         chat_id=OPERATOR_ID,
-                        document=doc_file['file_id'],
+                        document=doc_file.file_id,
                         caption=f"📎 Вложение к обращению: {appeal.topic}"
-                    )
+                    ))
             else:
                 # Группа файлов
                 media_group = MediaGroupBuilder(caption=f"📎 Вложения к обращению: {appeal.topic}")
                 
                 for doc_file in appeal.doc_files:
-                    if doc_file['type'] == 'photo':
-                        media_group.add_photo(media=doc_file['file_id'])
-                    elif doc_file['type'] == 'document':
-                        media_group.add_document(media=doc_file['file_id'])
+                    if doc_file.type == 'photo':
+                        media_group.add_photo(media=doc_file.file_id)
+                    elif doc_file.type == 'document':
+                        media_group.add_document(media=doc_file.file_id)
                 
-                await bot.send_media_group(
+                sent_messages.extend(await bot.send_media_group(
                     chat_id=OPERATOR_ID,
                     media=media_group.build()
-                )
+                ))
         
+        telegram_breaker.record_success()
         logger.info(f"Обращение отправлено оператору: {appeal.topic}")
-        return sent_message
         
     except Exception as e:
         logger.error(f"Ошибка отправки оператору: {e}")
+        record_error(e)
+        if is_telegram_channel_error(e):
+            telegram_breaker.record_failure(e)
+            if park and telegram_breaker.is_open:
+                park_appeal('telegram', appeal)
         return False
+    
+    # Ответы оператора на карточку и вложения пересылаются студенту.
+    # Регистрация выполняется вне доставки: ошибка журнала не считается
+    # сбоем канала и не приводит к повторной отправке карточки
+    if appeal.chat_id is not None:
+        reply_index.add(
+            (message.message_id for message in sent_messages),
+            chat_id=appeal.chat_id,
+            appeal_id=appeal.appeal_id
+        )
+    return True
+
+# Повторная доставка отложенных обращений
+async def redeliver_parked() -> None:
+    """Периодическая доставка отложенных обращений после восстановления каналов"""
+    senders = {'smtp': send_email, 'telegram': send_to_operator}
+    breakers = {'smtp': smtp_breaker, 'telegram': telegram_breaker}
+    
+    while True:
+        await asyncio.sleep(PARKED_RETRY_INTERVAL)
+        
+        for channel, queue in parked_appeals.items():
+            breaker = breakers[channel]
+            # Каждое обращение пробуется не больше одного раза за проход
+            for _ in range(len(queue)):
+                if not queue:
+                    break
+                # Обращение остается в очереди до окончания попытки, чтобы
+                # при остановке посреди нее оно было сохранено
+                appeal = queue[0]
+                failures = breaker.failures
+                async with admission.channel(channel, appeal_priority(appeal)):
+                    delivered = await senders[channel](appeal, park=False)
+                if not delivered and (breaker.state != CircuitState.CLOSED or breaker.failures > failures):
+                    # Канал все еще недоступен: очередь ждет следующего прохода
+                    break
+                
+                if queue and queue[0] is appeal:
+                    queue.popleft()
+                key = (channel, appeal.appeal_id)
+                if delivered:
+                    parked_attempts.pop(key, None)
+                    logger.info(f"Отложенное обращение доставлено ({channel}): {appeal.topic}")
+                    continue
+                
+                # Канал исправен, но не принимает это обращение
+                attempts = parked_attempts[key] = parked_attempts.get(key, 0) + 1
+                if attempts < PARKED_MAX_ATTEMPTS:
+                    queue.append(appeal)
+                    continue
+                del parked_attempts[key]
+                dead_letter_appeals[channel].append(appeal)
+                dead_letter_counter.inc(channel=channel)
+                logger.error(
+                    f"Обращение {appeal.appeal_id} не доставлено ({channel}) после "
+                    f"{attempts} попыток и снято с повторной доставки: {appeal.topic}"
+                )
+
+# Периодическое сохранение статистики
+async def save_analytics_snapshots() -> None:
+    while True:
+        await asyncio.sleep(ANALYTICS_SNAPSHOT_INTERVAL)
+        try:
+            # Снимок снимается в цикле событий, в поток уходит только запись
+            await asyncio.to_thread(analytics.save, analytics.to_dict())
+        except Exception as e:
+            logger.error(f"Ошибка сохранения снимка статистики: {e}")
+
+# Названия шагов диалога для статистики
+STEP_TITLES = {
+    AppealStates.waiting_for_agreement.state: "Соглашение",
+    AppealStates.selecting_instance.state: "Выбор инстанции",
+    AppealStates.entering_topic.state: "Тема",
+    AppealStates.entering_text.state: "Текст",
+    AppealStates.uploading_media.state: "Файлы",
+    AppealStates.entering_personal_data.state: "ФИО",
+    AppealStates.entering_contact_method.state: "Способ связи",
+    AppealStates.confirming_appeal.state: "Подтверждение"
+}
+
+def format_duration(seconds: Optional[float]) -> str:
+    """Форматирование длительности шага"""
+    if seconds is None:
+        return "—"
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
+
+def format_stats() -> str:
+    """Отчет по предварительно агрегированной статистике"""
+    today = analytics.today()
+    
+    lines = ["📊 <b>СТАТИСТИКА ОБРАЩЕНИЙ</b>", "", f"📅 <b>Сегодня:</b> {sum(today.values())}"]
+    lines += [f"• {instance}: {today[instance]}" for instance in INSTANCES if today[instance]]
+    
+    lines += ["", f"🗂 <b>Всего:</b> {sum(analytics.totals.values())}"]
+    lines += [f"• {instance}: {analytics.totals[instance]}" for instance in INSTANCES]
+    
+    lines += ["", "⏱ <b>Медиана времени на шаге (мин:сек):</b>"]
+    lines += [f"• {title}: {format_duration(analytics.median(state))}" for state, title in STEP_TITLES.items()]
+    
+    started = analytics.funnel[AppealStates.waiting_for_agreement.state]
+    confirming = analytics.funnel[AppealStates.confirming_appeal.state]
+    conversion = analytics.conversion(
+        AppealStates.waiting_for_agreement.state, AppealStates.confirming_appeal.state
+    )
+    lines += [
+        "",
+        "🔻 <b>Воронка:</b>",
+        f"• Начали диалог: {started}",
+        f"• Дошли до подтверждения: {confirming}"
+        + (f" (отсев {100 - conversion * 100:.0f}%)" if conversion is not None else ""),
+        f"• Отправили: {analytics.funnel['submitted']}"
+    ]
+    return "\n".join(lines)
+
+# Истечение брошенных черновиков
+async def on_session_expired(key: StorageKey, state: Optional[str], data: Dict) -> None:
+    """Обработка сессии, удаленной из-за бездействия или вытесненной при нехватке памяти"""
+    analytics.forget(key)
+    finish_trace(data.get('draft_id'), outcome='expired')
+    if SESSION_EXPIRE_NOTICE:
+        await notify_draft_expired(key, state, data)
+
+async def notify_draft_expired(key: StorageKey, state: Optional[str], data: Dict) -> None:
+    """Сообщение студенту о том, что незавершенное обращение удалено"""
+    if state is None or state == AppealStates.waiting_for_agreement.state:
+        return
+    if state not in AppealStates.__state_names__:
+        return
+
+    await bot.send_message(
+        chat_id=key.chat_id,
+        text="⌛ Черновик вашего обращения удален из-за долгого бездействия.\n\n"
+             "Вы можете начать заново в любой момент.",
+        reply_markup=get_main_menu_keyboard()
+    )
 
 # Обработчики команд
 @dp.message(Command("start"))
@@ -355,6 +823,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
     """Обработчик команды /start"""
     logger.info(f"Пользователь {message.from_user.id} запустил бота")
     
+    finish_trace((await state.get_data()).get('draft_id'), outcome='restarted')
     await state.clear()
     await message.answer(
         text=AGREEMENT_TEXT,
@@ -363,6 +832,40 @@ async def cmd_start(message: types.Message, state: FSMContext):
     )
     await state.set_state(AppealStates.waiting_for_agreement)
 
+# Ответ оператора регистрируется раньше обработчиков состояний,
+# чтобы срабатывать независимо от собственного состояния оператора
+@dp.message(F.chat.id == OPERATOR_ID, F.reply_to_message)
+async def operator_reply(message: types.Message):
+    """Пересылка ответа оператора студенту"""
+    target = reply_index.lookup(message.reply_to_message.message_id)
+    
+    if target is None:
+        await message.reply(
+            "❓ Не удалось определить обращение.\n\n"
+            "Ответьте на карточку обращения или на вложение к нему."
+        )
+        return
+    
+    try:
+        await bot.send_message(
+            chat_id=target.chat_id,
+            text="💬 <b>Ответ администрации Колледжа на ваше обращение:</b>",
+            parse_mode='HTML'
+        )
+        await message.copy_to(chat_id=target.chat_id)
+    except Exception as e:
+        logger.error(f"Ошибка пересылки ответа по обращению {target.appeal_id}: {e}")
+        await message.reply("❌ Не удалось доставить ответ студенту.")
+        return
+    
+    logger.info(f"Ответ оператора переслан по обращению {target.appeal_id}")
+    await message.reply("✅ Ответ отправлен студенту.")
+
+@dp.message(Command("stats"), F.chat.id == OPERATOR_ID)
+async def cmd_stats(message: types.Message):
+    """Статистика обращений для оператора"""
+    await message.answer(text=format_stats(), parse_mode='HTML')
+
 @dp.callback_query(F.data == "accept_agreement")
 async def accept_agreement(callback: types.CallbackQuery, state: FSMContext):
     """Принятие соглашения"""
@@ -383,6 +886,9 @@ async def start_new_appeal(callback: types.CallbackQuery, state: FSMContext):
         reply_markup=get_instances_keyboard(),
         parse_mode='HTML'
     )
+    draft_id = uuid.uuid4().hex
+    await state.update_data(draft_id=draft_id)
+    bind_trace(draft_id)
     await state.set_state(AppealStates.selecting_instance)
     await callback.answer()
 
@@ -459,7 +965,7 @@ async def receive_text(message: types.Message, state: FSMContext):
     await message.answer(
         text="📎 <b>Прикрепите медиа-файлы</b> (фото, документы)\n\n"
              "• Допустимые форматы: JPG, JPEG, PNG, PDF\n"
-             "• Максимальный размер: 10 МБ\n"
+             f"• Максимальный размер: {format_file_size(MAX_MEDIA_SIZE)}\n"
              "• Можно прикрепить несколько файлов\n\n"
              "Если файлы не нужны, нажмите «Пропустить»",        
         reply_markup=get_skip_media_keyboard(),
@@ -471,6 +977,7 @@ async def receive_text(message: types.Message, state: FSMContext):
 async def receive_media(message: types.Message, state: FSMContext):
     """Получение медиа-файлов"""
     data = await state.get_data()
+    # Вложения хранятся в данных FSM кортежами (см. Attachment.to_tuple)
     media_files = data.get('media_files', [])
     doc_files = data.get('doc_files', [])
     
@@ -485,15 +992,10 @@ async def receive_media(message: types.Message, state: FSMContext):
         file_size = file_info.file_size
         
         # Проверка размера файла
-        if file_size > 10 * 1024 * 1024:  # 10 МБ
+        if file_size > MAX_MEDIA_SIZE:
             return  # Молча игнорируем слишком большие файлы
         
-        media_files.append({
-            'type': 'photo',
-            'file_id': file_id,
-            'file_name': file_name,
-            'file_size': file_size
-        })
+        media_files.append(Attachment('photo', file_id, file_name, file_size).to_tuple())
         
     elif message.content_type == 'document':
         document = message.document
@@ -502,19 +1004,14 @@ async def receive_media(message: types.Message, state: FSMContext):
         file_size = document.file_size
         
         # Проверка размера файла
-        if file_size > 10 * 1024 * 1024:  # 10 МБ
+        if file_size > MAX_MEDIA_SIZE:
             return  # Молча игнорируем слишком большие файлы
         
         # Проверка формата файла
         if not is_valid_media_format(file_name):
             return  # Молча игнорируем неподдерживаемые форматы
         
-        doc_files.append({
-            'type': 'document',
-            'file_id': file_id,
-            'file_name': file_name,
-            'file_size': file_size
-        })
+        doc_files.append(Attachment('document', file_id, file_name, file_size).to_tuple())
     
     await state.update_data(media_files=media_files, doc_files=doc_files)
 
@@ -540,8 +1037,8 @@ async def skip_media_upload(callback: types.CallbackQuery, state: FSMContext):
 async def finish_media_upload(callback: types.CallbackQuery, state: FSMContext):
     """Завершение загрузки медиа"""
     data = await state.get_data()
-    media_files = data.get('media_files', [])
-    doc_files = data.get('doc_files', [])
+    media_files = load_attachments(data.get('media_files'))
+    doc_files = load_attachments(data.get('doc_files'))
     
     if len(media_files) == 0 and len(doc_files) == 0:
         report_text = "📎 Файлы не загружены."
@@ -550,9 +1047,9 @@ async def finish_media_upload(callback: types.CallbackQuery, state: FSMContext):
         report_text += f"✅ Успешно загружено: {len(media_files)} фото и {len(doc_files)} документов\n\n"
         
         for i, file in enumerate(media_files, 1):
-            report_text += f"{i}. {file['file_name']} ({format_file_size(file['file_size'])})\n"
+            report_text += f"{i}. {file.file_name} ({format_file_size(file.file_size)})\n"
         for i, file in enumerate(doc_files, 1):
-            report_text += f"{i}. {file['file_name']} ({format_file_size(file['file_size'])})\n"
+            report_text += f"{i}. {file.file_name} ({format_file_size(file.file_size)})\n"
 
 
     
@@ -636,14 +1133,40 @@ async def receive_contact_method(message: types.Message, state: FSMContext):
     
     await message.answer(
         text=summary,
-        reply_markup=get_confirm_keyboard(),
+        reply_markup=get_confirm_keyboard(data.get('draft_id')),
         parse_mode='HTML'
     )
     await state.set_state(AppealStates.confirming_appeal)
 
-@dp.callback_query(F.data == "send_appeal", StateFilter(AppealStates.confirming_appeal))
+@dp.callback_query(F.data.startswith("send_appeal"))
 async def send_appeal(callback: types.CallbackQuery, state: FSMContext):
     """Отправка обращения"""
+    draft_id = callback.data.partition(":")[2] or None
+    user_id = callback.from_user.id
+    
+    # Повторные нажатия отвечаются сразу, без повторной доставки
+    if submissions.result(draft_id) is not None:
+        duplicate_submissions_counter.inc(reason="completed")
+        await callback.answer("✅ Это обращение уже отправлено")
+        return
+    if submissions.busy(user_id):
+        duplicate_submissions_counter.inc(reason="in_progress")
+        await callback.answer("⏳ Обращение уже отправляется")
+        return
+    
+    # Доставка учитывается до первого ожидания, чтобы остановка бота
+    # дождалась и отправок, еще не дошедших до каналов
+    async with delivery_tracker.track(None, channels=('telegram', 'smtp')) as delivery, \
+            submissions.submitting(user_id):
+        if await state.get_state() != AppealStates.confirming_appeal.state:
+            await callback.answer()
+            return
+        await submit_appeal(callback, state, draft_id, delivery)
+
+async def submit_appeal(
+    callback: types.CallbackQuery, state: FSMContext, draft_id: Optional[str], delivery: Delivery
+):
+    """Сохранение и доставка обращения"""
     data = await state.get_data()
     
     # Создание объекта обращения
@@ -654,16 +1177,69 @@ async def send_appeal(callback: types.CallbackQuery, state: FSMContext):
         full_name=data['full_name'],
         contact_method=data['contact_method'],
         media_files=data.get('media_files', []),
-        doc_files=data.get('doc_files', [])
+        doc_files=data.get('doc_files', []),
+        chat_id=callback.message.chat.id,
+        appeal_id=draft_id
     )
+    delivery.payload = appeal
     
-    await callback.message.edit_text("⏳ Отправляем ваше обращение...")
+    # Колбэк отвечается до очереди: иначе кнопка показывает загрузку все
+    # ожидание, а поздний ответ отклоняется Telegram как устаревший
+    try:
+        await callback.answer()
+    except Exception as e:
+        logger.debug(f"Не удалось ответить на колбэк отправки: {e}")
     
-    # Отправка оператору
-    operator_success = await send_to_operator(appeal)
+    sending_text = "⏳ Отправляем ваше обращение..."
+    await callback.message.edit_text(sending_text)
     
-    # Отправка на почту
-    email_success = await send_email(appeal)
+    # Сохранение обращения (в отдельном потоке, чтобы не блокировать бота)
+    try:
+        with span("store_save"):
+            await asyncio.to_thread(appeal_store.save, appeal.to_dict())
+    except Exception as e:
+        logger.error(f"Ошибка сохранения обращения {appeal.appeal_id}: {e}")
+    
+    priority = appeal_priority(appeal)
+    queued = False
+    
+    async def show_queue_position(position: int):
+        nonlocal queued
+        queued = True
+        await callback.message.edit_text(f"{sending_text}\n\n🕐 Ваше место в очереди: {position}")
+    
+    try:
+        async with admission.admit(on_position=show_queue_position, priority=priority):
+            if queued:
+                await callback.message.edit_text(sending_text)
+            
+            # Отправка оператору
+            async with admission.channel('telegram', priority):
+                operator_success = await send_to_operator(appeal)
+            delivery.settle('telegram')
+            
+            # Отправка на почту
+            async with admission.channel('smtp', priority):
+                email_success = await send_email(appeal)
+            delivery.settle('smtp')
+        
+        # Обращение учитывается только после приема в очередь: отклоненный
+        # черновик студент отправляет повторно
+        analytics.on_submitted(appeal.instance, appeal.created_at)
+        if draft_id:
+            submissions.complete(draft_id, appeal.appeal_id)
+    except AdmissionRejected as e:
+        logger.warning(f"Очередь на отправку переполнена, обращение не принято: {appeal.topic}")
+        record_error(e)
+        # Студент отправит черновик заново, при остановке сохранять нечего
+        delivery.settle('telegram')
+        delivery.settle('smtp')
+        await callback.message.edit_text(
+            text="⚠️ Сейчас поступает слишком много обращений.\n\n"
+                 "Пожалуйста, попробуйте отправить еще раз через несколько минут.",
+            reply_markup=get_confirm_keyboard(draft_id)
+        )
+        return
     
     if operator_success and email_success:
         success_message = """
@@ -687,6 +1263,14 @@ async def send_appeal(callback: types.CallbackQuery, state: FSMContext):
         
         logger.warning(f"Частичная отправка обращения: {appeal.topic}")
     
+    finish_trace(
+        draft_id,
+        failed=not (operator_success and email_success),
+        outcome='submitted',
+        instance=appeal.instance,
+        priority=priority
+    )
+    
     await callback.message.edit_text(
         text=success_message,
         reply_markup=get_main_menu_keyboard(),
@@ -694,11 +1278,11 @@ async def send_appeal(callback: types.CallbackQuery, state: FSMContext):
     )
     
     await state.clear()
-    await callback.answer()
 
 @dp.callback_query(F.data == "cancel_appeal")
 async def cancel_appeal(callback: types.CallbackQuery, state: FSMContext):
     """Отмена обращения"""
+    finish_trace((await state.get_data()).get('draft_id'), outcome='cancelled')
     await callback.message.edit_text(
         text="❌ Обращение отменено.\n\nВыберите действие:",
         reply_markup=get_main_menu_keyboard()
@@ -716,6 +1300,25 @@ async def unknown_message(message: types.Message):
         reply_markup=get_main_menu_keyboard()
     )
 
+# Сохранение недоставленных обращений между перезапусками
+def persist_pending_appeals(unfinished) -> None:
+    """Сохранение прерванных и отложенных обращений"""
+    records = [
+        {'channels': sorted(delivery.channels), 'appeal': delivery.payload.to_dict()}
+        for delivery in unfinished
+    ]
+    for channel, queue in parked_appeals.items():
+        records.extend({'channels': [channel], 'appeal': appeal.to_dict()} for appeal in queue)
+    
+    save_pending(PENDING_APPEALS_FILE, records)
+
+def restore_pending_appeals() -> None:
+    """Постановка сохраненных обращений в очередь повторной доставки"""
+    for record in load_pending(PENDING_APPEALS_FILE):
+        appeal = Appeal.from_dict(record['appeal'])
+        for channel in record['channels']:
+            parked_appeals[channel].append(appeal)
+
 # Основная функция запуска
 async def main():
     """Запуск бота"""
@@ -729,13 +1332,41 @@ async def main():
     logger.info(f"Бот настроен для оператора ID: {OPERATOR_ID}")
     logger.info(f"Корпоративная почта: {CORPORATE_EMAIL}")
     
+    # Очистка брошенных черновиков
+    storage.on_expire = on_session_expired
+    storage.start_reaper(SESSION_REAP_INTERVAL)
+    
+    analytics.load()
+    snapshot_task = asyncio.create_task(save_analytics_snapshots())
+    
+    redelivery_task = asyncio.create_task(redeliver_parked())
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    
+    restore_pending_appeals()
+    reply_index.load()
+    
     try:
-        # Запуск поллинга
-        await bot.delete_webhook(drop_pending_updates=True)
-        await dp.start_polling(bot)
+        # Запуск поллинга; по SIGTERM/SIGINT поллинг останавливается,
+        # а сессия бота закрывается только после завершения доставок
+        await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+        await dp.start_polling(bot, close_bot_session=False)
     except Exception as e:
         logger.error(f"Ошибка запуска бота: {e}")
     finally:
+        logger.info("Остановка бота")
+        redelivery_task.cancel()
+        snapshot_task.cancel()
+        await asyncio.gather(redelivery_task, snapshot_task, return_exceptions=True)
+        analytics.save()
+        unfinished = await delivery_tracker.drain(SHUTDOWN_TIMEOUT)
+        persist_pending_appeals(unfinished)
+        # Обновления подтверждаются, когда их обращения доставлены или сохранены
+        await update_offsets.confirm(bot)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await storage.close()
         await bot.session.close()
 
 if __name__ == "__main__":
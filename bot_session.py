@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, AsyncGenerator, Dict, FrozenSet, Optional
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from metrics import REGISTRY
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+api_latency_histogram = REGISTRY.histogram(
+    "hotline_bot_api_latency_seconds", "Время выполнения запросов к Bot API", ["method"]
+)
+api_errors_counter = REGISTRY.counter(
+    "hotline_bot_api_errors_total", "Ошибки запросов к Bot API", ["method", "error"]
+)
+api_retries_counter = REGISTRY.counter(
+    "hotline_bot_api_retries_total", "Повторные запросы к Bot API", ["method"]
+)
+
+# Методы, которые безопасно повторять после сетевой ошибки: повторный
+# вызов не создает новых сообщений. getUpdates повторяет сам поллинг.
+IDEMPOTENT_METHODS = frozenset({
+    "getFile",
+    "getMe",
+    "getChat",
+    "deleteWebhook",
+    "editMessageText",
+    "editMessageReplyMarkup",
+})
+
+
+def is_applied_edit(name: str, error: Exception) -> bool:
+    """
+    Повтор редактирования отклонен, потому что первая попытка уже дошла.
+
+    Если ответ на editMessage* потерялся из-за сетевой ошибки, сообщение
+    уже изменено, и повтор получает «message is not modified».
+    """
+    return (
+        name.startswith("editMessage")
+        and isinstance(error, TelegramBadRequest)
+        and "message is not modified" in error.message
+    )
+
+
+def parse_timeouts(value: str) -> Dict[str, float]:
+    """Разбор таймаутов вида «getFile=10,sendMediaGroup=60»"""
+    timeouts = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, timeout = item.split("=")
+        timeouts[name.strip()] = float(timeout)
+    return timeouts
+
+
+class TunedAiohttpSession(AiohttpSession):
+    """
+    Сессия Bot API с настраиваемым пулом соединений, таймаутами по методам,
+    повторами с джиттером и метриками задержек и ошибок.
+
+    Повторяются только идемпотентные методы после сетевых и серверных ошибок;
+    ответ 429 (flood control) повторяется для любого метода, так как запрос
+    не был выполнен.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 0,
+        keepalive_timeout: float = 30,
+        ttl_dns_cache: int = 300,
+        method_timeouts: Optional[Dict[str, float]] = None,
+        retry_attempts: int = 3,
+        retry_base_delay: float = 0.5,
+        retry_max_delay: float = 10,
+        idempotent_methods: FrozenSet[str] = IDEMPOTENT_METHODS,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(limit=limit, **kwargs)
+        self._connector_init.update(
+            limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive_timeout,
+            ttl_dns_cache=ttl_dns_cache,
+        )
+        self.method_timeouts = method_timeouts or {}
+        self.retry_attempts = retry_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.idempotent_methods = idempotent_methods
+
+    def backoff(self, attempt: int) -> float:
+        """Экспоненциальная задержка с полным джиттером"""
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** (attempt - 1)))
+
+    async def make_request(
+        self, bot: Bot, method: TelegramMethod[TelegramType], timeout: Optional[int] = None
+    ) -> TelegramType:
+        name = method.__api_method__
+        if timeout is None:
+            timeout = self.method_timeouts.get(name)
+        idempotent = name in self.idempotent_methods
+
+        with span(f"bot_api.{name}") as current:
+            attempt = 1
+            while True:
+                if current is not None:
+                    current.attributes["attempts"] = attempt
+                started = time.monotonic()
+                try:
+                    result = await super().make_request(bot, method, timeout)
+                except TelegramRetryAfter as e:
+                    api_errors_counter.inc(method=name, error="RetryAfter")
+                    if attempt >= self.retry_attempts or e.retry_after > self.retry_max_delay:
+                        raise
+                    delay = e.retry_after
+                except (TelegramNetworkError, TelegramServerError) as e:
+                    api_errors_counter.inc(method=name, error=type(e).__name__)
+                    if not idempotent or attempt >= self.retry_attempts:
+                        raise
+                    delay = self.backoff(attempt)
+                except Exception as e:
+                    if attempt > 1 and is_applied_edit(name, e):
+                        logger.info(f"Повтор {name} не нужен: изменение уже применено")
+                        return True
+                    api_errors_counter.inc(method=name, error=type(e).__name__)
+                    raise
+                else:
+                    api_latency_histogram.observe(time.monotonic() - started, method=name)
+                    return result
+
+                api_retries_counter.inc(method=name)
+                logger.warning(f"Повтор запроса {name} через {delay:.2f} с (попытка {attempt + 1})")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def stream_content(
+        self,
+        url: str,
+        headers: Optional[Dict[str, Any]] = None,
+        timeout: int = 30,
+        chunk_size: int = 65536,
+        raise_for_status: bool = True,
+    ) -> AsyncGenerator[bytes, None]:
+        timeout = int(self.method_timeouts.get("downloadFile", timeout))
+        started = time.monotonic()
+        try:
+            async for chunk in super().stream_content(
+                url, headers=headers, timeout=timeout, chunk_size=chunk_size, raise_for_status=raise_for_status
+            ):
+                yield chunk
+        except Exception as e:
+            api_errors_counter.inc(method="downloadFile", error=type(e).__name__)
+            raise
+        api_latency_histogram.observe(time.monotonic() - started, method="downloadFile")
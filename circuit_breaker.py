@@ -0,0 +1,119 @@
+import logging
+import time
+from enum import Enum
+from typing import Dict, Optional
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+channel_state_gauge = REGISTRY.gauge(
+    "hotline_channel_state", "Состояние канала: 0 - closed, 1 - half-open, 2 - open", ["channel"]
+)
+channel_failures_counter = REGISTRY.counter(
+    "hotline_channel_failures_total", "Количество ошибок канала доставки", ["channel"]
+)
+channel_rejected_counter = REGISTRY.counter(
+    "hotline_channel_rejected_total", "Количество вызовов, отклоненных открытым автоматом", ["channel"]
+)
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+
+STATE_VALUES = {CircuitState.CLOSED: 0, CircuitState.HALF_OPEN: 1, CircuitState.OPEN: 2}
+
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель для канала доставки.
+
+    После failure_threshold ошибок подряд канал открывается и вызовы
+    отклоняются сразу. Через recovery_timeout канал переходит в half-open
+    и пропускает до half_open_max_calls пробных вызовов: успех закрывает
+    канал, ошибка снова открывает.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 60,
+        half_open_max_calls: int = 1,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.half_open_calls = 0
+        self.last_error: Optional[str] = None
+        self._publish()
+
+    def _publish(self) -> None:
+        channel_state_gauge.set(STATE_VALUES[self.state], channel=self.name)
+
+    def _transition(self, state: CircuitState) -> None:
+        if state == self.state:
+            return
+        logger.warning(f"Канал {self.name}: {self.state.value} -> {state.value}")
+        self.state = state
+        self._publish()
+
+    def allow_request(self) -> bool:
+        """Можно ли выполнить вызов через канал"""
+        if self.state == CircuitState.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                channel_rejected_counter.inc(channel=self.name)
+                return False
+            self._transition(CircuitState.HALF_OPEN)
+            self.half_open_calls = 0
+
+        if self.state == CircuitState.HALF_OPEN:
+            if self.half_open_calls >= self.half_open_max_calls:
+                channel_rejected_counter.inc(channel=self.name)
+                return False
+            self.half_open_calls += 1
+
+        return True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.last_error = None
+        self._transition(CircuitState.CLOSED)
+
+    def record_failure(self, error: Optional[BaseException] = None) -> None:
+        self.failures += 1
+        channel_failures_counter.inc(channel=self.name)
+        if error is not None:
+            self.last_error = str(error)
+
+        if self.state == CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._transition(CircuitState.OPEN)
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == CircuitState.OPEN
+
+    def reset(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.half_open_calls = 0
+        self.last_error = None
+        self._transition(CircuitState.CLOSED)
+
+    def health(self) -> Dict:
+        """Состояние канала для мониторинга"""
+        return {
+            "healthy": self.state != CircuitState.OPEN,
+            "state": self.state.value,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
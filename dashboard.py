@@ -0,0 +1,194 @@
+"""
+Панель оператора: HTTP API и страница просмотра обращений (только чтение).
+
+Запускается отдельным процессом, чтобы не конкурировать с циклом событий бота:
+
+    python dashboard.py
+"""
+import hmac
+import os
+from datetime import date, datetime, timezone
+from typing import Optional, Tuple
+from urllib.parse import urlencode
+
+from dotenv_vault import load_dotenv
+from flask import Flask, Response, abort, jsonify, render_template_string, request
+
+from appeal_store import AppealStore
+
+MAX_PAGE_SIZE = 200
+
+LIST_TEMPLATE = """<!doctype html>
+<html lang="ru">
+<head>
+<meta charset="utf-8">
+<title>Обращения студентов</title>
+<style>
+body { font-family: sans-serif; margin: 2em; }
+table { border-collapse: collapse; width: 100%; }
+th, td { border: 1px solid #ccc; padding: 6px; text-align: left; vertical-align: top; }
+td.text { white-space: pre-wrap; max-width: 40em; }
+form > * { margin-right: 1em; }
+</style>
+</head>
+<body>
+<h1>Обращения студентов</h1>
+<form method="get">
+  <select name="instance">
+    <option value="">Все инстанции</option>
+    {% for name in instances %}
+    <option value="{{ name }}" {% if name == instance %}selected{% endif %}>{{ name }}</option>
+    {% endfor %}
+  </select>
+  <label>с <input type="date" name="from" value="{{ date_from or '' }}"></label>
+  <label>по <input type="date" name="to" value="{{ date_to or '' }}"></label>
+  <button type="submit">Показать</button>
+</form>
+<table>
+  <tr><th>Дата</th><th>Инстанция</th><th>Тема</th><th>ФИО</th><th>Связь</th><th>Текст</th><th>Файлов</th></tr>
+  {% for item in items %}
+  <tr>
+    <td>{{ item.created_at[:16].replace('T', ' ') }}</td>
+    <td>{{ item.instance }}</td>
+    <td>{{ item.topic }}</td>
+    <td>{{ item.full_name }}</td>
+    <td>{{ item.contact_method }}</td>
+    <td class="text">{{ item.text }}</td>
+    <td>{{ item.attachments|length }}</td>
+  </tr>
+  {% else %}
+  <tr><td colspan="7">Обращений не найдено</td></tr>
+  {% endfor %}
+</table>
+{% if next_cursor %}
+<p><a href="?{{ next_query }}">Следующая страница →</a></p>
+{% endif %}
+</body>
+</html>
+"""
+
+
+def parse_date(value: Optional[str]) -> Optional[date]:
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        abort(400, description=f"Некорректная дата: {value}")
+
+
+def create_app(store: AppealStore, token: Optional[str] = None) -> Flask:
+    app = Flask(__name__)
+
+    @app.before_request
+    def check_token():
+        """Доступ по токену (Bearer или пароль HTTP Basic), если он задан"""
+        if not token:
+            return None
+
+        supplied = None
+        if request.authorization is not None:
+            supplied = request.authorization.token or request.authorization.password
+        if supplied and hmac.compare_digest(supplied, token):
+            return None
+
+        return Response(
+            "Требуется авторизация", 401, {"WWW-Authenticate": 'Basic realm="hotline"'}
+        )
+
+    def current_version() -> Tuple[str, datetime]:
+        rowid, stored_at = store.version()
+        etag = f"{rowid}-{int(stored_at * 1000)}"
+        last_modified = datetime.fromtimestamp(int(stored_at), tz=timezone.utc)
+        return etag, last_modified
+
+    def not_modified(etag: str, last_modified: datetime) -> bool:
+        """Проверка условного запроса до выполнения выборки"""
+        if request.if_none_match:
+            return request.if_none_match.contains(etag)
+        if request.if_modified_since is not None:
+            return last_modified <= request.if_modified_since
+        return False
+
+    def conditional(etag: str, last_modified: datetime, response: Response) -> Response:
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        return response
+
+    def page_params():
+        try:
+            limit = min(int(request.args.get("limit", 50)), MAX_PAGE_SIZE)
+        except ValueError:
+            abort(400, description="Некорректный limit")
+        return dict(
+            instance=request.args.get("instance") or None,
+            date_from=parse_date(request.args.get("from")),
+            date_to=parse_date(request.args.get("to")),
+            cursor=request.args.get("cursor") or None,
+            limit=max(limit, 1),
+        )
+
+    def fetch_page(params):
+        try:
+            return store.list(**params)
+        except ValueError as e:
+            abort(400, description=str(e))
+
+    @app.errorhandler(400)
+    def bad_request(error):
+        return jsonify(error=error.description), 400
+
+    @app.get("/api/appeals")
+    def api_appeals():
+        etag, last_modified = current_version()
+        if not_modified(etag, last_modified):
+            return conditional(etag, last_modified, Response(status=304))
+
+        items, next_cursor = fetch_page(page_params())
+        return conditional(etag, last_modified, jsonify(items=items, next_cursor=next_cursor))
+
+    @app.get("/api/appeals/<appeal_id>")
+    def api_appeal(appeal_id: str):
+        item = store.get(appeal_id)
+        if item is None:
+            return jsonify(error="Обращение не найдено"), 404
+        return jsonify(item)
+
+    @app.get("/")
+    def index():
+        etag, last_modified = current_version()
+        if not_modified(etag, last_modified):
+            return conditional(etag, last_modified, Response(status=304))
+
+        params = page_params()
+        items, next_cursor = fetch_page(params)
+
+        next_args = request.args.to_dict()
+        next_args["cursor"] = next_cursor or ""
+        html = render_template_string(
+            LIST_TEMPLATE,
+            items=items,
+            instances=store.instances(),
+            instance=params["instance"],
+            date_from=request.args.get("from"),
+            date_to=request.args.get("to"),
+            next_cursor=next_cursor,
+            next_query=urlencode(next_args),
+        )
+        return conditional(etag, last_modified, Response(html, mimetype="text/html"))
+
+    return app
+
+
+if __name__ == "__main__":
+    load_dotenv("~/KMB-hotline/.env")
+
+    app = create_app(
+        AppealStore(os.getenv("APPEALS_DB", "appeals.db"), read_only=True),
+        token=os.getenv("DASHBOARD_TOKEN"),
+    )
+    app.run(
+        host=os.getenv("DASHBOARD_HOST", "127.0.0.1"),
+        port=int(os.getenv("DASHBOARD_PORT", "8080")),
+    )
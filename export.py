@@ -0,0 +1,156 @@
+"""
+Выгрузка обращений в CSV, JSON Lines или Parquet.
+
+Обращения читаются из базы потоком и сразу записываются в файл, поэтому
+расход памяти не зависит от объема истории:
+
+    python export.py --month 2025-06 --format csv --output june.csv
+    python export.py --from 2025-01-01 --instance "Организация питания" --redact --format parquet --output food.parquet
+"""
+import argparse
+import calendar
+import csv
+import json
+import os
+import sys
+from datetime import date
+from itertools import islice
+from typing import Dict, Iterable, Iterator, Optional, TextIO, Tuple
+
+from appeal_store import AppealStore
+
+EXPORT_COLUMNS = (
+    "appeal_id", "created_at", "instance", "topic", "text",
+    "full_name", "contact_method", "attachments_count",
+)
+REDACTED_FIELDS = ("full_name", "contact_method")
+REDACTED_VALUE = "***"
+PARQUET_BATCH_SIZE = 1000
+
+
+def to_record(appeal: Dict) -> Dict:
+    """Преобразование обращения в строку выгрузки"""
+    record = {name: appeal.get(name) for name in EXPORT_COLUMNS}
+    record["attachments_count"] = len(appeal.get("attachments") or [])
+    return record
+
+
+def redact(records: Iterable[Dict]) -> Iterator[Dict]:
+    """Скрытие персональных данных"""
+    for record in records:
+        for name in REDACTED_FIELDS:
+            record[name] = REDACTED_VALUE
+        yield record
+
+
+def write_csv(records: Iterable[Dict], stream: TextIO) -> int:
+    writer = csv.DictWriter(stream, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    count = 0
+    for record in records:
+        writer.writerow(record)
+        count += 1
+    return count
+
+
+def write_jsonl(records: Iterable[Dict], stream: TextIO) -> int:
+    count = 0
+    for record in records:
+        stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def write_parquet(records: Iterable[Dict], path: str) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Для выгрузки в Parquet установите pyarrow: pip install pyarrow")
+
+    schema = pa.schema([
+        (name, pa.int64() if name == "attachments_count" else pa.string())
+        for name in EXPORT_COLUMNS
+    ])
+    records = iter(records)
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        # Запись группами строк, чтобы в памяти был только один пакет
+        while True:
+            batch = list(islice(records, PARQUET_BATCH_SIZE))
+            if not batch:
+                break
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+            count += len(batch)
+    return count
+
+
+def export_appeals(
+    store: AppealStore,
+    fmt: str,
+    output: Optional[str] = None,
+    instance: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    redact_pii: bool = False,
+) -> int:
+    """Выгрузка обращений, возвращает количество записей"""
+    records = map(to_record, store.iter_appeals(instance=instance, date_from=date_from, date_to=date_to))
+    if redact_pii:
+        records = redact(records)
+
+    if fmt == "parquet":
+        if not output:
+            raise ValueError("Для формата parquet нужно указать --output")
+        return write_parquet(records, output)
+
+    writer = write_csv if fmt == "csv" else write_jsonl
+    if not output:
+        return writer(records, sys.stdout)
+    with open(output, "w", encoding="utf-8", newline="") as stream:
+        return writer(records, stream)
+
+
+def month_range(value: str) -> Tuple[date, date]:
+    """Первый и последний день месяца вида «2025-06»"""
+    year, month = map(int, value.split("-"))
+    return date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Выгрузка обращений студентов")
+    parser.add_argument("--db", default=os.getenv("APPEALS_DB", "appeals.db"), help="файл базы обращений")
+    parser.add_argument("--format", choices=("csv", "jsonl", "parquet"), default="csv")
+    parser.add_argument("--output", help="файл выгрузки (по умолчанию stdout для csv и jsonl)")
+    parser.add_argument("--instance", help="только обращения в указанную инстанцию")
+    parser.add_argument("--from", dest="date_from", type=date.fromisoformat, help="с даты (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="date_to", type=date.fromisoformat, help="по дату включительно (YYYY-MM-DD)")
+    parser.add_argument("--month", help="за месяц (YYYY-MM), вместо --from/--to")
+    parser.add_argument("--redact", action="store_true", help="скрыть ФИО и способ связи")
+    args = parser.parse_args(argv)
+
+    date_from, date_to = args.date_from, args.date_to
+    if args.month:
+        date_from, date_to = month_range(args.month)
+
+    try:
+        store = AppealStore(args.db, read_only=True)
+    except FileNotFoundError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    count = export_appeals(
+        store,
+        args.format,
+        output=args.output,
+        instance=args.instance,
+        date_from=date_from,
+        date_to=date_to,
+        redact_pii=args.redact,
+    )
+    print(f"Выгружено обращений: {count}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
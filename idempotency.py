@@ -0,0 +1,73 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Hashable, List, Optional, Tuple
+
+from metrics import REGISTRY
+
+duplicate_submissions_counter = REGISTRY.counter(
+    "hotline_duplicate_submissions_total", "Повторные нажатия отправки, не вызвавшие повторной доставки", ["reason"]
+)
+
+
+class SubmissionGuard:
+    """
+    Защита от повторной отправки одного черновика обращения.
+
+    Отправка выполняется под блокировкой пользователя; пока она держится,
+    повторные нажатия отклоняются сразу, без ожидания. Ключи уже
+    отправленных черновиков хранятся ttl секунд (не больше max_entries),
+    чтобы повтор колбэка после завершения тоже не вызывал доставку.
+    """
+
+    def __init__(self, ttl: float = 600, max_entries: int = 10000) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Блокировка пользователя и число задач, которые ее держат или ждут
+        self.locks: Dict[Hashable, List] = {}
+        self.completed: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    def _expire(self, now: float) -> None:
+        deadline = now - self.ttl
+        while self.completed:
+            completed_at, _ = next(iter(self.completed.values()))
+            if completed_at > deadline:
+                break
+            self.completed.popitem(last=False)
+
+    def result(self, key: Optional[str]) -> Optional[str]:
+        """Идентификатор обращения, если черновик с этим ключом уже отправлен"""
+        if key is None:
+            return None
+        self._expire(time.monotonic())
+        entry = self.completed.get(key)
+        return entry[1] if entry else None
+
+    def complete(self, key: str, appeal_id: str) -> None:
+        now = time.monotonic()
+        self._expire(now)
+        self.completed[key] = (now, appeal_id)
+        self.completed.move_to_end(key)
+        while len(self.completed) > self.max_entries:
+            self.completed.popitem(last=False)
+
+    def busy(self, user_id: Hashable) -> bool:
+        entry = self.locks.get(user_id)
+        return entry is not None and entry[0].locked()
+
+    @asynccontextmanager
+    async def submitting(self, user_id: Hashable) -> AsyncIterator[None]:
+        """Блокировка отправки для пользователя"""
+        entry = self.locks.get(user_id)
+        if entry is None:
+            entry = self.locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            # Блокировка удаляется, когда ее никто не держит и не ждет
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[user_id]
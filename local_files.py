@@ -0,0 +1,70 @@
+import base64
+from pathlib import Path
+from typing import BinaryIO, Optional, Union
+
+from aiogram.client.telegram import (
+    BareFilesPathWrapper,
+    FilesPathWrapper,
+    SimpleFilesPathWrapper,
+    TelegramAPIServer,
+)
+
+# Ограничение облачного Bot API на скачивание файлов ботом
+CLOUD_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+
+# Блок кодирования кратен 57 байтам: base64 каждого блока состоит из целых
+# строк по 76 символов, и строки не разрываются на границах блоков
+BASE64_CHUNK = 57 * 1024
+
+
+def parse_path_mapping(value: str) -> FilesPathWrapper:
+    """
+    Разбор соответствия каталогов вида «/var/lib/telegram-bot-api:/mnt/bot-api».
+
+    Нужно, если каталог сервера Bot API смонтирован у бота по другому пути
+    (например, в соседнем контейнере). Пустая строка — пути совпадают.
+    """
+    if not value:
+        return BareFilesPathWrapper()
+    server_path, local_path = value.rsplit(":", 1)
+    return SimpleFilesPathWrapper(Path(server_path), Path(local_path))
+
+
+def local_api_server(base_url: str, path_mapping: str = "") -> TelegramAPIServer:
+    """Собственный сервер Bot API, запущенный с флагом --local"""
+    return TelegramAPIServer.from_base(
+        base_url.rstrip("/"), is_local=True, wrap_local_file=parse_path_mapping(path_mapping)
+    )
+
+
+def encode_base64_stream(source: BinaryIO, out: BinaryIO) -> None:
+    """
+    Base64 содержимого файла в формате вложения письма (строки по 76 символов).
+
+    Файл кодируется блоками и сразу пишется в out, так что в памяти
+    находится один блок, а не весь файл и его base64.
+    """
+    while True:
+        chunk = source.read(BASE64_CHUNK)
+        if not chunk:
+            break
+        out.write(base64.encodebytes(chunk))
+
+
+def encode_base64_file(path: Union[str, Path], out: BinaryIO) -> None:
+    """Base64 файла с диска (см. encode_base64_stream)"""
+    with open(path, "rb") as f:
+        encode_base64_stream(f, out)
+
+
+def media_size_limit(configured: Optional[int], is_local: bool, default: int = 10 * 1024 * 1024) -> int:
+    """
+    Максимальный размер принимаемого файла.
+
+    Облачный Bot API не отдает ботам файлы больше 20 МБ, поэтому без
+    локального сервера больший лимит не имеет смысла.
+    """
+    limit = configured or default
+    if not is_local:
+        limit = min(limit, CLOUD_DOWNLOAD_LIMIT)
+    return limit
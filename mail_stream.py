@@ -0,0 +1,103 @@
+import smtplib
+import tempfile
+import uuid
+from contextlib import contextmanager
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from typing import BinaryIO, Iterator
+
+
+class MessageSpool:
+    """
+    Письмо MIME, собираемое во временном файле.
+
+    Заголовки и небольшие части формирует пакет email, а содержимое
+    вложений (base64) дописывается в файл по частям, поэтому письмо с
+    крупными вложениями не копируется в память целиком ни при сборке, ни
+    при отправке через send_message_file. Письма не больше max_size байт
+    остаются в памяти.
+    """
+
+    def __init__(self, msg: MIMEMultipart, max_size: int = 1024 * 1024) -> None:
+        if msg.get_boundary() is None:
+            msg.set_boundary(f"==============={uuid.uuid4().hex}==")
+        self.boundary = msg.get_boundary()
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        # Части письма дописываются в файл, поэтому берутся только заголовки
+        headers = msg.as_string().split("\n\n", 1)[0]
+        self._write(f"{headers}\n\n")
+
+    def __enter__(self) -> "MessageSpool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.file.close()
+
+    def _write(self, text: str) -> None:
+        self.file.write(text.encode("ascii"))
+
+    def add(self, part: MIMEBase) -> None:
+        """Часть письма целиком (текст обращения)"""
+        self._write(f"--{self.boundary}\n{part.as_string()}\n")
+
+    @contextmanager
+    def attachment(self, part: MIMEBase) -> Iterator[BinaryIO]:
+        """
+        Часть, содержимое которой записывает вызывающий код.
+
+        part — только заголовки; закодированное содержимое пишется в
+        возвращаемый файл. При ошибке записанная часть удаляется из письма.
+        """
+        start = self.file.tell()
+        self._write(f"--{self.boundary}\n{part.as_string()}")
+        try:
+            yield self.file
+        except Exception:
+            self.file.seek(start)
+            self.file.truncate(start)
+            raise
+        self._write("\n")
+
+    def finish(self) -> BinaryIO:
+        """Завершение письма; файл готов к отправке"""
+        self._write(f"--{self.boundary}--\n")
+        self.file.seek(0)
+        return self.file
+
+
+def send_message_file(
+    server: smtplib.SMTP, sender: str, recipient: str, message: BinaryIO, block_size: int = 64 * 1024
+) -> None:
+    """
+    Отправка письма из файла без чтения его в память целиком.
+
+    Аналог SMTP.sendmail: строки передаются блоками по block_size байт,
+    концы строк заменяются на CRLF, а начальная точка удваивается, как
+    того требует команда DATA.
+    """
+    server.ehlo_or_helo_if_needed()
+    code, resp = server.mail(sender)
+    if code != 250:
+        raise smtplib.SMTPSenderRefused(code, resp, sender)
+    code, resp = server.rcpt(recipient)
+    if code not in (250, 251):
+        raise smtplib.SMTPRecipientsRefused({recipient: (code, resp)})
+    code, resp = server.docmd("data")
+    if code != 354:
+        raise smtplib.SMTPDataError(code, resp)
+
+    buffer = bytearray()
+    for line in message:
+        if line.startswith(b"."):
+            buffer += b"."
+        buffer += line.rstrip(b"\r\n")
+        buffer += b"\r\n"
+        if len(buffer) >= block_size:
+            server.send(bytes(buffer))
+            buffer.clear()
+    buffer += b".\r\n"
+    server.send(bytes(buffer))
+
+    code, resp = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
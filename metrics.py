@@ -0,0 +1,203 @@
+import json
+import logging
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    """Базовая метрика с метками"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._format_labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+
+class CallbackGauge(Metric):
+    """Гауж, значения которого вычисляются при каждом запросе метрик"""
+
+    kind = "gauge"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str], function: Callable[[], Dict]
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, value in self.function().items():
+            key = key if isinstance(key, tuple) else (key,)
+            lines.append(f"{self.name}{self._format_labels(key)} {value}")
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # Для каждого набора меток: счетчики по корзинам, сумма и количество
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def count(self, **labels: str) -> int:
+        state = self.values.get(self._key(labels))
+        return int(state[-1]) if state else 0
+
+    def mean(self, **labels: str) -> float:
+        state = self.values.get(self._key(labels))
+        return state[-2] / state[-1] if state and state[-1] else 0.0
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, state in self.values.items():
+            cumulative = 0
+            for bound, hits in zip(self.buckets + (float("inf"),), state):
+                cumulative += hits
+                le = "+Inf" if bound == float("inf") else f"{bound}"
+                labels = self._format_labels(key, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {state[-2]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {state[-1]}")
+        return lines
+
+
+class Registry:
+    """Реестр метрик и проверок состояния"""
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+        self.health_checks: Dict[str, Callable[[], Dict]] = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def callback_gauge(
+        self, name: str, documentation: str, labelnames: Sequence[str], function: Callable[[], Dict]
+    ) -> CallbackGauge:
+        """function возвращает значения по меткам: {значение_метки или кортеж: число}"""
+        return self._register(CallbackGauge(name, documentation, labelnames, function))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def register_health(self, name: str, check: Callable[[], Dict]) -> None:
+        self.health_checks[name] = check
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+    def health(self) -> Dict[str, Dict]:
+        return {name: check() for name, check in self.health_checks.items()}
+
+
+REGISTRY = Registry()
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+async def health_handler(request: web.Request) -> web.Response:
+    health = REGISTRY.health()
+    healthy = all(check.get("healthy", True) for check in health.values())
+    return web.Response(
+        text=json.dumps(health, ensure_ascii=False, default=str),
+        status=200 if healthy else 503,
+        content_type="application/json",
+    )
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Запуск HTTP-сервера с /metrics и /health"""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/health", health_handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,118 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Iterable, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ReplyTarget(NamedTuple):
+    chat_id: int
+    appeal_id: str
+    created_at: float
+
+
+class ReplyIndex:
+    """
+    Индекс «сообщение в чате оператора -> студент и обращение».
+
+    Записи хранятся в памяти (поиск за O(1)) в порядке добавления и
+    ограничены по количеству и сроку хранения. Для восстановления после
+    перезапуска каждая запись дописывается в JSONL-журнал, который
+    периодически перезаписывается только актуальными записями.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_entries: int = 50000,
+        ttl: float = 90 * 24 * 60 * 60,
+    ) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[int, ReplyTarget]" = OrderedDict()
+        self._journal_lines = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _insert(self, message_id: int, target: ReplyTarget) -> None:
+        self.entries[message_id] = target
+        self.entries.move_to_end(message_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _expire(self, now: float) -> None:
+        deadline = now - self.ttl
+        while self.entries:
+            message_id, target = next(iter(self.entries.items()))
+            if target.created_at > deadline:
+                break
+            self.entries.popitem(last=False)
+
+    def add(self, message_ids: Iterable[int], chat_id: int, appeal_id: str) -> None:
+        """Регистрация сообщений оператору, относящихся к обращению"""
+        now = time.time()
+        target = ReplyTarget(chat_id, appeal_id, now)
+        message_ids = list(message_ids)
+        for message_id in message_ids:
+            self._insert(message_id, target)
+        self._expire(now)
+
+        if self.path:
+            self._append(message_ids, target)
+
+    def lookup(self, message_id: int) -> Optional[ReplyTarget]:
+        target = self.entries.get(message_id)
+        if target is None:
+            return None
+        if target.created_at <= time.time() - self.ttl:
+            return None
+        return target
+
+    def _append(self, message_ids: Iterable[int], target: ReplyTarget) -> None:
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                for message_id in message_ids:
+                    f.write(json.dumps([message_id, *target]) + "\n")
+                    self._journal_lines += 1
+        except OSError as e:
+            logger.error(f"Ошибка записи индекса ответов: {e}")
+            return
+
+        # Журнал не должен расти бесконечно
+        if self._journal_lines > 2 * max(len(self.entries), 1000):
+            self.compact()
+
+    def compact(self) -> None:
+        """Перезапись журнала только актуальными записями"""
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for message_id, target in self.entries.items():
+                    f.write(json.dumps([message_id, *target]) + "\n")
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Ошибка сжатия индекса ответов: {e}")
+            return
+        self._journal_lines = len(self.entries)
+
+    def load(self) -> None:
+        """Восстановление индекса из журнала"""
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                self._journal_lines += 1
+                try:
+                    message_id, chat_id, appeal_id, created_at = json.loads(line)
+                except ValueError:
+                    continue
+                self._insert(message_id, ReplyTarget(chat_id, appeal_id, created_at))
+
+        self._expire(time.time())
+        logger.info(f"Загружен индекс ответов: {len(self.entries)} сообщений")
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import pickle
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+logger = logging.getLogger(__name__)
+
+# Колбэк, вызываемый при истечении сессии: (ключ, состояние, данные)
+ExpireCallback = Callable[[StorageKey, Optional[str], Dict[str, Any]], Awaitable[None]]
+# Колбэк смены состояния: (ключ, прежнее состояние, новое состояние)
+StateChangeCallback = Callable[[StorageKey, Optional[str], Optional[str]], None]
+
+
+@dataclass
+class SessionRecord:
+    data: Dict[str, Any] = field(default_factory=dict)
+    state: Optional[str] = None
+    size: int = 0
+    touched_at: float = field(default_factory=time.monotonic)
+
+
+def estimate_size(data: Dict[str, Any]) -> int:
+    """Оценка объема данных сессии в байтах"""
+    if not data:
+        return 0
+    try:
+        return len(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return len(repr(data).encode('utf-8'))
+
+
+class BoundedMemoryStorage(BaseStorage):
+    """
+    FSM-хранилище в памяти с ограничением по числу сессий и объему данных.
+
+    Сессии хранятся в порядке последнего обращения (LRU): при превышении
+    лимитов вытесняются самые давно не использовавшиеся. Фоновый сборщик
+    удаляет сессии, простаивающие дольше idle_timeout. О вытесненных и
+    истекших сессиях сообщает один и тот же колбэк on_expire.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        max_bytes: int = 64 * 1024 * 1024,
+        idle_timeout: float = 24 * 60 * 60,
+        on_expire: Optional[ExpireCallback] = None,
+        on_state_change: Optional[StateChangeCallback] = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.on_expire = on_expire
+        self.on_state_change = on_state_change
+        self.records: "OrderedDict[StorageKey, SessionRecord]" = OrderedDict()
+        self.total_bytes = 0
+        self.evicted = 0
+        self.expired = 0
+        self._reaper_task: Optional[asyncio.Task] = None
+
+    def _touch(self, key: StorageKey) -> SessionRecord:
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = SessionRecord()
+        else:
+            self.records.move_to_end(key)
+        record.touched_at = time.monotonic()
+        return record
+
+    def _drop(self, key: StorageKey) -> Optional[SessionRecord]:
+        record = self.records.pop(key, None)
+        if record is not None:
+            self.total_bytes -= record.size
+        return record
+
+    def _release_if_empty(self, key: StorageKey, record: SessionRecord) -> None:
+        # Пустые сессии (после state.clear()) не занимают место
+        if record.state is None and not record.data:
+            self._drop(key)
+
+    async def _enforce_limits(self) -> None:
+        evicted: List[tuple] = []
+        while self.records and (
+            len(self.records) > self.max_entries or self.total_bytes > self.max_bytes
+        ):
+            key, record = self.records.popitem(last=False)
+            self.total_bytes -= record.size
+            self.evicted += 1
+            evicted.append((key, record))
+            logger.warning(f"Сессия {key.user_id} вытеснена из хранилища (лимит памяти)")
+        await self._notify_expired(evicted)
+
+    async def _notify_expired(self, expired: List[tuple]) -> None:
+        if self.on_expire is None:
+            return
+        for key, record in expired:
+            try:
+                await self.on_expire(key, record.state, record.data)
+            except Exception as e:
+                logger.error(f"Ошибка обработки истекшей сессии {key.user_id}: {e}")
+
+    async def close(self) -> None:
+        await self.stop_reaper()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._touch(key)
+        old_state = record.state
+        record.state = state.state if isinstance(state, State) else state
+        if self.on_state_change is not None and old_state != record.state:
+            self.on_state_change(key, old_state, record.state)
+        self._release_if_empty(key, record)
+        await self._enforce_limits()
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self.records.get(key)
+        if record is None:
+            return None
+        self._touch(key)
+        return record.state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = self._touch(key)
+        record.data = data.copy()
+        size = estimate_size(record.data)
+        self.total_bytes += size - record.size
+        record.size = size
+        self._release_if_empty(key, record)
+        await self._enforce_limits()
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self.records.get(key)
+        if record is None:
+            return {}
+        self._touch(key)
+        return record.data.copy()
+
+    def state_counts(self) -> Dict[str, int]:
+        """Количество активных сессий по состояниям"""
+        return dict(Counter(record.state or "none" for record in self.records.values()))
+
+    def health(self) -> Dict:
+        """Состояние хранилища для мониторинга"""
+        return {
+            "sessions": len(self.records),
+            "bytes": self.total_bytes,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "states": self.state_counts(),
+        }
+
+    async def reap(self, now: Optional[float] = None) -> int:
+        """Удаление простаивающих сессий, возвращает их количество"""
+        if now is None:
+            now = time.monotonic()
+        deadline = now - self.idle_timeout
+        expired: List[tuple] = []
+
+        # Записи упорядочены по времени обращения, поэтому достаточно
+        # пройти от начала до первой «живой» сессии
+        while self.records:
+            key, record = next(iter(self.records.items()))
+            if record.touched_at > deadline:
+                break
+            self._drop(key)
+            expired.append((key, record))
+
+        self.expired += len(expired)
+        for key, record in expired:
+            logger.info(f"Сессия пользователя {key.user_id} истекла ({record.state})")
+        await self._notify_expired(expired)
+        return len(expired)
+
+    async def _reaper_loop(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.reap()
+
+    def start_reaper(self, interval: float = 60) -> None:
+        """Запуск фоновой очистки простаивающих сессий"""
+        if self._reaper_task is None or self._reaper_task.done():
+            self._reaper_task = asyncio.create_task(self._reaper_loop(interval))
+
+    async def stop_reaper(self) -> None:
+        if self._reaper_task is not None:
+            self._reaper_task.cancel()
+            try:
+                await self._reaper_task
+            except asyncio.CancelledError:
+                pass
+            self._reaper_task = None
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.types import TelegramObject, Update
+
+logger = logging.getLogger(__name__)
+
+
+class Delivery:
+    """
+    Доставка одного обращения по нескольким каналам.
+
+    payload может быть назначен позже, когда обращение собрано: доставка
+    учитывается с первого шага обработки, а незавершенная доставка без
+    обращения при остановке не сохраняется.
+    """
+
+    def __init__(self, payload: Any, channels: Iterable[str]) -> None:
+        self.payload = payload
+        self.channels: Set[str] = set(channels)
+
+    def settle(self, channel: str) -> None:
+        """Канал обработан (доставлено, отложено или окончательная ошибка)"""
+        self.channels.discard(channel)
+
+
+class DeliveryTracker:
+    """
+    Учет выполняющихся доставок для корректной остановки бота.
+
+    Каждая доставка связывается с задачей, в которой она выполняется.
+    При остановке drain() ждет их завершения до дедлайна и возвращает
+    доставки, которые не успели завершиться.
+    """
+
+    def __init__(self) -> None:
+        self.inflight: Dict[asyncio.Task, Delivery] = {}
+
+    @asynccontextmanager
+    async def track(self, payload: Any, channels: Iterable[str]) -> AsyncIterator[Delivery]:
+        delivery = Delivery(payload, channels)
+        task = asyncio.current_task()
+        self.inflight[task] = delivery
+        try:
+            yield delivery
+        finally:
+            self.inflight.pop(task, None)
+
+    async def drain(self, timeout: float) -> List[Delivery]:
+        """Ожидание выполняющихся доставок, возвращает незавершенные"""
+        if not self.inflight:
+            return []
+
+        logger.info(f"Ожидание завершения доставок: {len(self.inflight)}")
+        _, pending = await asyncio.wait(set(self.inflight), timeout=timeout)
+
+        unfinished = [self.inflight[task] for task in pending if task in self.inflight]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        return [delivery for delivery in unfinished if delivery.payload is not None and delivery.channels]
+
+
+class UpdateOffsetMiddleware(BaseMiddleware):
+    """
+    Запоминает последний полученный update_id.
+
+    Поллинг подтверждает обновления только следующим запросом getUpdates,
+    поэтому при остановке последний offset подтверждается явно.
+    """
+
+    def __init__(self) -> None:
+        self.last_update_id: Optional[int] = None
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        if self.last_update_id is None or event.update_id > self.last_update_id:
+            self.last_update_id = event.update_id
+        return await handler(event, data)
+
+    async def confirm(self, bot: Bot) -> None:
+        if self.last_update_id is None:
+            return
+        try:
+            await bot.get_updates(offset=self.last_update_id + 1, limit=1, timeout=0)
+        except Exception as e:
+            logger.error(f"Не удалось подтвердить обновления: {e}")
+
+
+def save_pending(path: str, records: List[Dict]) -> None:
+    """Сохранение недоставленных обращений на диск"""
+    if not records:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(records, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    logger.warning(f"Сохранено недоставленных обращений: {len(records)}")
+
+
+def load_pending(path: str) -> List[Dict]:
+    """Загрузка недоставленных обращений, сохраненных при прошлой остановке"""
+    if not os.path.exists(path):
+        return []
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            records = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Ошибка чтения файла недоставленных обращений {path}: {e}")
+        return []
+
+    os.remove(path)
+    logger.info(f"Загружено недоставленных обращений: {len(records)}")
+    return records
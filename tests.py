@@ -1,7 +1,50 @@
 import pytest
 import asyncio
+import base64
+import csv
+import email
+import email.header
+import io
+import json
+import random
+import smtplib
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 from unittest.mock import AsyncMock, Mock, patch
-from bot import Appeal, is_valid_media_format, format_file_size, send_email, send_to_operator
+from aiohttp import test_utils, web
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.methods import EditMessageText, GetFile, SendMessage
+from aiogram.types import CallbackQuery
+from bot import (
+    Appeal, AppealStates, Attachment, is_valid_media_format, format_file_size, send_email, send_to_operator,
+    smtp_breaker, parked_appeals, operator_reply, format_stats, send_appeal, redeliver_parked,
+    save_analytics_snapshots, telegram_breaker, dead_letter_appeals,
+    is_smtp_channel_error, submit_appeal
+)
+from admission import AdmissionController, AdmissionRejected, delivery_latency_histogram, parse_priorities
+from analytics import Analytics, P2Quantile
+from appeal_store import AppealStore
+from bot_session import TunedAiohttpSession, api_latency_histogram, api_retries_counter, parse_timeouts
+from circuit_breaker import CircuitBreaker, CircuitState
+from local_files import CLOUD_DOWNLOAD_LIMIT, encode_base64_file, encode_base64_stream, local_api_server, media_size_limit
+from mail_stream import MessageSpool, send_message_file
+from metrics import Registry
+from dashboard import create_app
+from export import export_appeals, month_range, main as export_main
+from idempotency import SubmissionGuard
+from reply_index import ReplyIndex
+from session_storage import BoundedMemoryStorage
+from shutdown import Delivery, DeliveryTracker, load_pending, save_pending
+from throttling import SlidingWindow, ThrottlingMiddleware, parse_limits
+from tracing import Tracer, TracingMiddleware, bind_trace, finish_trace, span
 
 
 class TestUtilityFunctions:
@@ -69,7 +112,19 @@ class TestAppealDataClass:
         )
         
         assert len(appeal.media_files) == 1
-        assert appeal.media_files[0]['file_name'] == 'photo.jpg'
+        assert appeal.media_files[0].file_name == 'photo.jpg'
+
+
+def smtp_server_mock() -> Mock:
+    """SMTP-сервер, принимающий письмо; переданные данные собираются в sent"""
+    server = Mock()
+    server.mail.return_value = (250, b"OK")
+    server.rcpt.return_value = (250, b"OK")
+    server.docmd.return_value = (354, b"Go ahead")
+    server.getreply.return_value = (250, b"Queued")
+    server.sent = bytearray()
+    server.send.side_effect = server.sent.extend
+    return server
 
 
 class TestEmailIntegration:
@@ -81,7 +136,7 @@ class TestEmailIntegration:
     async def test_send_email_success(self, mock_bot, mock_smtp):
         """Тест успешной отправки email"""
         # Настройка мока
-        mock_server = Mock()
+        mock_server = smtp_server_mock()
         mock_smtp.return_value = mock_server
         mock_bot.get_file = AsyncMock()
         mock_bot.download_file = AsyncMock()
@@ -100,16 +155,19 @@ class TestEmailIntegration:
              patch('bot.SMTP_PASSWORD', 'password'), \
              patch('bot.CORPORATE_EMAIL', 'corp@test.com'), \
              patch('bot.SMTP_SERVER', 'smtp.test.com'), \
-             patch('bot.SMTP_PORT', 587):
+             patch('bot.SMTP_PORT', 587), \
+             patch('bot.SMTP_TIMEOUT', 15):
             
             result = await send_email(appeal)
             
             # Проверки
             assert result == True
-            mock_smtp.assert_called_once_with('smtp.test.com', 587)
+            mock_smtp.assert_called_once_with('smtp.test.com', 587, timeout=15)
             mock_server.starttls.assert_called_once()
             mock_server.login.assert_called_once_with('sender@test.com', 'password')
-            mock_server.sendmail.assert_called_once()
+            mock_server.mail.assert_called_once_with('sender@test.com')
+            mock_server.rcpt.assert_called_once_with('corp@test.com')
+            assert mock_server.sent.endswith(b"\r\n.\r\n")
             mock_server.quit.assert_called_once()
     
     @pytest.mark.asyncio
@@ -129,6 +187,60 @@ class TestEmailIntegration:
         
         result = await send_email(appeal)
         assert result == False
+    
+    @pytest.mark.asyncio
+    @patch('bot.smtplib.SMTP')
+    async def test_send_email_timeout_counts_as_failure(self, mock_smtp):
+        """Тест учета таймаута SMTP как сбоя канала"""
+        mock_smtp.side_effect = TimeoutError("timed out")
+        appeal = Appeal(
+            instance="Директор",
+            topic="Тест таймаута",
+            text="Тестовое сообщение",
+            full_name="Тестов Тест Тестович",
+            contact_method="test@example.com"
+        )
+        
+        smtp_breaker.reset()
+        try:
+            assert await send_email(appeal, park=False) == False
+            assert smtp_breaker.failures == 1
+        finally:
+            smtp_breaker.reset()
+    
+    @pytest.mark.asyncio
+    async def test_smtp_channel_limits_sessions(self):
+        """Тест ограничения числа одновременных SMTP-сессий"""
+        controller = AdmissionController(channel_limits={'smtp': 2})
+        active = 0
+        peak = 0
+        lock = threading.Lock()
+        
+        def slow_delivery(text):
+            nonlocal active, peak
+            with lock:
+                active += 1
+                peak = max(peak, active)
+            time.sleep(0.05)
+            with lock:
+                active -= 1
+        
+        async def deliver(i):
+            appeal = Appeal(
+                instance="Директор",
+                topic=f"Тест {i}",
+                text="Тестовое сообщение",
+                full_name="Тестов Тест Тестович",
+                contact_method="test@example.com"
+            )
+            async with controller.channel('smtp'):
+                return await send_email(appeal, park=False)
+        
+        with patch('bot.deliver_email', slow_delivery):
+            results = await asyncio.gather(*(deliver(i) for i in range(6)))
+        
+        assert all(results)
+        assert peak == 2
 
 
 class TestTelegramIntegration:
@@ -258,6 +370,1328 @@ class TestValidation:
             assert len(name.strip()) < 5
 
 
+class TestBoundedMemoryStorage:
+    """Тесты ограниченного хранилища сессий"""
+    
+    @staticmethod
+    def make_key(user_id):
+        return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+    
+    @pytest.mark.asyncio
+    async def test_lru_eviction(self):
+        """Тест вытеснения давно не использовавшихся сессий"""
+        storage = BoundedMemoryStorage(max_entries=2)
+        
+        await storage.set_state(self.make_key(1), AppealStates.entering_topic)
+        await storage.set_state(self.make_key(2), AppealStates.entering_text)
+        await storage.get_state(self.make_key(1))  # Пользователь 1 снова активен
+        await storage.set_state(self.make_key(3), AppealStates.entering_topic)
+        
+        assert await storage.get_state(self.make_key(1)) == AppealStates.entering_topic.state
+        assert await storage.get_state(self.make_key(2)) is None
+        assert storage.evicted == 1
+        assert storage.state_counts() == {AppealStates.entering_topic.state: 2}
+    
+    @pytest.mark.asyncio
+    async def test_byte_limit_and_clear(self):
+        """Тест учета объема данных и освобождения после очистки"""
+        storage = BoundedMemoryStorage(max_bytes=6000)
+        
+        await storage.set_data(self.make_key(1), {'text': "А" * 2000})
+        await storage.set_data(self.make_key(2), {'text': "Б" * 2000})
+        assert len(storage.records) == 1
+        
+        await storage.set_state(self.make_key(2), None)
+        await storage.set_data(self.make_key(2), {})
+        assert len(storage.records) == 0
+        assert storage.total_bytes == 0
+    
+    @pytest.mark.asyncio
+    async def test_reap_idle_sessions(self):
+        """Тест удаления брошенных черновиков с уведомлением"""
+        on_expire = AsyncMock()
+        storage = BoundedMemoryStorage(idle_timeout=60, on_expire=on_expire)
+        
+        await storage.set_state(self.make_key(1), AppealStates.uploading_media)
+        await storage.set_data(self.make_key(1), {'media_files': []})
+        
+        assert await storage.reap() == 0
+        assert await storage.reap(now=time.monotonic() + 120) == 1
+        on_expire.assert_called_once_with(
+            self.make_key(1), AppealStates.uploading_media.state, {'media_files': []}
+        )
+        assert storage.records == {}
+    
+    @pytest.mark.asyncio
+    async def test_evicted_session_reported(self):
+        """Тест уведомления о сессии, вытесненной при превышении лимита"""
+        on_expire = AsyncMock()
+        storage = BoundedMemoryStorage(max_entries=1, on_expire=on_expire)
+        
+        await storage.set_state(self.make_key(1), AppealStates.entering_text)
+        await storage.set_data(self.make_key(1), {'draft_id': 'd1'})
+        await storage.set_state(self.make_key(2), AppealStates.entering_topic)
+        
+        on_expire.assert_awaited_once_with(
+            self.make_key(1), AppealStates.entering_text.state, {'draft_id': 'd1'}
+        )
+        assert storage.evicted == 1
+    
+    @pytest.mark.asyncio
+    async def test_state_counts_exported(self):
+        """Тест публикации числа сессий по состояниям в метриках и /health"""
+        storage = BoundedMemoryStorage()
+        await storage.set_state(self.make_key(1), AppealStates.entering_text)
+        await storage.set_state(self.make_key(2), AppealStates.entering_text)
+        await storage.set_state(self.make_key(3), AppealStates.confirming_appeal)
+        
+        registry = Registry()
+        registry.callback_gauge("sessions", "Диалоги", ["state"], storage.state_counts)
+        registry.register_health("sessions", storage.health)
+        
+        assert f'sessions{{state="{AppealStates.entering_text.state}"}} 2' in registry.render()
+        assert registry.health()["sessions"]["states"][AppealStates.confirming_appeal.state] == 1
+
+
+class TestThrottling:
+    """Тесты ограничения частоты запросов"""
+    
+    def test_sliding_window(self):
+        """Тест скользящего окна"""
+        window = SlidingWindow(now=0)
+        
+        assert all(window.hit(now=i, limit=3, period=10) for i in range(3))
+        assert window.hit(now=5, limit=3, period=10) == False
+        
+        # В начале следующего окна учитываются события предыдущего
+        assert window.hit(now=10, limit=3, period=10) == False
+        # Через два окна история забыта
+        assert window.hit(now=35, limit=3, period=10) == True
+    
+    def test_limit_resolution(self):
+        """Тест выбора лимита по обработчику и состоянию"""
+        middleware = ThrottlingMiddleware(
+            default_limit=(10, 60),
+            limits={'receive_media': (2, 60), AppealStates.entering_text.state: (1, 60)}
+        )
+        handler = Mock()
+        handler.callback.__name__ = 'receive_media'
+        
+        assert middleware.resolve_limit({'handler': handler}) == ('receive_media', (2, 60))
+        assert middleware.resolve_limit(
+            {'raw_state': AppealStates.entering_text.state}
+        ) == (AppealStates.entering_text.state, (1, 60))
+        assert middleware.resolve_limit({}) == ('default', (10, 60))
+        assert parse_limits("receive_media=30/60, unknown_message=5/10") == {
+            'receive_media': (30, 60.0), 'unknown_message': (5, 10.0)
+        }
+    
+    @pytest.mark.asyncio
+    async def test_drops_flood(self):
+        """Тест отбрасывания лишних сообщений до обработчика"""
+        middleware = ThrottlingMiddleware(default_limit=(2, 60))
+        handler = AsyncMock(return_value="ok")
+        user = Mock()
+        user.id = 42
+        
+        results = [await middleware(handler, Mock(), {'event_from_user': user}) for _ in range(5)]
+        
+        assert results == ["ok", "ok", None, None, None]
+        assert handler.call_count == 2
+        assert middleware.dropped == 3
+    
+    @pytest.mark.asyncio
+    async def test_dropped_callback_answered(self):
+        """Тест ответа на отброшенный колбэк, чтобы кнопка не зависала"""
+        middleware = ThrottlingMiddleware(default_limit=(1, 60))
+        handler = AsyncMock(return_value="ok")
+        user = Mock()
+        user.id = 42
+        callback = Mock(spec=CallbackQuery)
+        callback.answer = AsyncMock()
+        
+        await middleware(handler, callback, {'event_from_user': user})
+        assert await middleware(handler, callback, {'event_from_user': user}) is None
+        
+        assert handler.call_count == 1
+        callback.answer.assert_awaited_once_with()
+
+
+class TestCircuitBreaker:
+    """Тесты автоматических выключателей каналов"""
+    
+    def test_state_transitions(self):
+        """Тест переходов closed -> open -> half-open -> closed"""
+        breaker = CircuitBreaker("test", failure_threshold=2, recovery_timeout=60)
+        
+        breaker.record_failure(Exception("timeout"))
+        assert breaker.allow_request() == True
+        breaker.record_failure(Exception("timeout"))
+        assert breaker.state == CircuitState.OPEN
+        assert breaker.allow_request() == False
+        assert breaker.health()['healthy'] == False
+        
+        # После таймаута пропускается один пробный вызов
+        breaker.opened_at -= 61
+        assert breaker.allow_request() == True
+        assert breaker.state == CircuitState.HALF_OPEN
+        assert breaker.allow_request() == False
+        
+        breaker.record_success()
+        assert breaker.state == CircuitState.CLOSED
+        assert breaker.allow_request() == True
+    
+    def test_half_open_failure_reopens(self):
+        """Тест повторного открытия после неудачной пробы"""
+        breaker = CircuitBreaker("test", failure_threshold=1, recovery_timeout=0)
+        
+        breaker.record_failure()
+        assert breaker.allow_request() == True
+        breaker.record_failure()
+        assert breaker.state == CircuitState.OPEN
+    
+    @pytest.mark.asyncio
+    @patch('bot.smtplib.SMTP')
+    async def test_open_channel_parks_appeal(self, mock_smtp):
+        """Тест быстрого отказа и откладывания обращения при открытом канале"""
+        appeal = Appeal(
+            instance="Директор",
+            topic="Тест выключателя",
+            text="Тестовое сообщение",
+            full_name="Тестов Тест Тестович",
+            contact_method="test@example.com"
+        )
+        
+        for _ in range(smtp_breaker.failure_threshold):
+            smtp_breaker.record_failure()
+        try:
+            result = await send_email(appeal)
+            
+            assert result == False
+            mock_smtp.assert_not_called()
+            assert list(parked_appeals['smtp']) == [appeal]
+        finally:
+            smtp_breaker.reset()
+            parked_appeals['smtp'].clear()
+    
+    def test_smtp_error_classification(self):
+        """Тест отличия недоступности SMTP от отказа принять письмо"""
+        assert is_smtp_channel_error(smtplib.SMTPServerDisconnected("closed"))
+        assert is_smtp_channel_error(TimeoutError("timed out"))
+        assert is_smtp_channel_error(smtplib.SMTPDataError(451, b"Try again later"))
+        assert is_smtp_channel_error(smtplib.SMTPAuthenticationError(535, b"Bad credentials"))
+        assert not is_smtp_channel_error(smtplib.SMTPDataError(552, b"Message too large"))
+        assert not is_smtp_channel_error(ValueError("bad header"))
+    
+    @pytest.mark.asyncio
+    @patch('bot.bot')
+    async def test_content_error_not_counted(self, mock_bot):
+        """Тест ошибки из-за содержимого обращения, не влияющей на канал"""
+        mock_bot.send_message = AsyncMock(side_effect=TelegramBadRequest(
+            method=SendMessage(chat_id=1, text="x"), message="Bad Request: can't parse entities"
+        ))
+        appeal = Appeal(
+            instance="Директор",
+            topic="a < b",
+            text="Текст",
+            full_name="Тестов Тест",
+            contact_method="Telegram"
+        )
+        
+        telegram_breaker.reset()
+        for _ in range(telegram_breaker.failure_threshold):
+            assert await send_to_operator(appeal) == False
+        
+        assert telegram_breaker.failures == 0
+        assert not parked_appeals['telegram']
+    
+    @pytest.mark.asyncio
+    async def test_undeliverable_appeal_does_not_block_queue(self):
+        """Тест перемещения неотправляемого обращения в конец очереди и затем в dead letter"""
+        appeals = [
+            Appeal(instance="Директор", topic=topic, text="Текст", full_name="Тестов Тест", contact_method="Telegram")
+            for topic in ("bad", "t100", "t101")
+        ]
+        sent = []
+        
+        async def deliver(appeal, park=True):
+            if appeal.topic == "bad":
+                return False
+            sent.append(appeal.topic)
+            return True
+        
+        telegram_breaker.reset()
+        parked_appeals['telegram'].extend(appeals)
+        try:
+            with patch('bot.PARKED_RETRY_INTERVAL', 0), patch('bot.PARKED_MAX_ATTEMPTS', 2), \
+                 patch('bot.send_to_operator', deliver):
+                task = asyncio.create_task(redeliver_parked())
+                for _ in range(100):
+                    if dead_letter_appeals['telegram']:
+                        break
+                    await asyncio.sleep(0.01)
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            
+            assert sent == ["t100", "t101"]
+            assert not parked_appeals['telegram']
+            assert list(dead_letter_appeals['telegram']) == [appeals[0]]
+            assert telegram_breaker.state == CircuitState.CLOSED
+        finally:
+            parked_appeals['telegram'].clear()
+            dead_letter_appeals['telegram'].clear()
+
+
+class TestGracefulShutdown:
+    """Тесты корректной остановки"""
+    
+    @pytest.mark.asyncio
+    async def test_submission_tracked_before_first_await(self):
+        """Тест учета отправки до сборки обращения"""
+        release = asyncio.Event()
+        callback = Mock()
+        callback.data = "send_appeal:draft1"
+        callback.from_user.id = 42
+        callback.answer = AsyncMock()
+        
+        async def get_state():
+            await release.wait()
+            return None
+        
+        state = Mock()
+        state.get_state = get_state
+        
+        with patch('bot.delivery_tracker', DeliveryTracker()) as tracker, \
+             patch('bot.submissions', SubmissionGuard()):
+            task = asyncio.create_task(send_appeal(callback, state))
+            await asyncio.sleep(0)
+            assert task in tracker.inflight
+            
+            drain = asyncio.create_task(tracker.drain(1))
+            await asyncio.sleep(0)
+            assert not drain.done()
+            release.set()
+            
+            assert await drain == []
+            assert task.done()
+    
+    @pytest.mark.asyncio
+    async def test_cancelled_redelivery_keeps_appeal(self):
+        """Тест сохранения отложенного обращения при остановке посреди доставки"""
+        appeal = Appeal(
+            instance="Директор",
+            topic="Отложенное",
+            text="Текст",
+            full_name="Тестов Тест",
+            contact_method="test@example.com"
+        )
+        started = asyncio.Event()
+        
+        async def slow_send(appeal, park=True):
+            started.set()
+            await asyncio.sleep(10)
+            return True
+        
+        parked_appeals['telegram'].append(appeal)
+        try:
+            with patch('bot.PARKED_RETRY_INTERVAL', 0), patch('bot.send_to_operator', slow_send):
+                task = asyncio.create_task(redeliver_parked())
+                await started.wait()
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            
+            assert list(parked_appeals['telegram']) == [appeal]
+        finally:
+            parked_appeals['telegram'].clear()
+    
+    @pytest.mark.asyncio
+    async def test_drain_waits_and_reports_unfinished(self):
+        """Тест ожидания доставок и возврата незавершенных"""
+        tracker = DeliveryTracker()
+        
+        async def deliver(payload, delay):
+            async with tracker.track(payload, channels=('telegram', 'smtp')) as delivery:
+                delivery.settle('telegram')
+                await asyncio.sleep(delay)
+                delivery.settle('smtp')
+        
+        fast = asyncio.create_task(deliver("fast", 0.01))
+        slow = asyncio.create_task(deliver("slow", 10))
+        await asyncio.sleep(0)
+        
+        unfinished = await tracker.drain(timeout=0.1)
+        
+        assert fast.done() and not fast.cancelled()
+        assert slow.cancelled()
+        assert [(d.payload, d.channels) for d in unfinished] == [("slow", {'smtp'})]
+        assert tracker.inflight == {}
+    
+    def test_pending_roundtrip(self, tmp_path):
+        """Тест сохранения и загрузки недоставленных обращений"""
+        appeal = Appeal(
+            instance="Директор",
+            topic="Недоставленное обращение",
+            text="Текст обращения",
+            full_name="Иванов Иван Иванович",
+            contact_method="Telegram",
+            media_files=[{'type': 'photo', 'file_id': 'p1', 'file_name': 'photo_1.jpg', 'file_size': 1024}]
+        )
+        path = str(tmp_path / "pending.json")
+        
+        save_pending(path, [{'channels': ['smtp'], 'appeal': appeal.to_dict()}])
+        records = load_pending(path)
+        
+        assert records[0]['channels'] == ['smtp']
+        assert Appeal.from_dict(records[0]['appeal']) == appeal
+        assert load_pending(path) == []
+
+
+class TestAdmissionControl:
+    """Тесты ограничения одновременной отправки"""
+    
+    @pytest.mark.asyncio
+    async def test_position_updates_rate_limited(self):
+        """Тест общего ограничения частоты уведомлений о месте в очереди"""
+        controller = AdmissionController(max_concurrent=1, max_queue=10, position_interval=0.01, position_rate=1)
+        release = asyncio.Event()
+        notifications = []
+        
+        async def submit(name):
+            async def on_position(position):
+                notifications.append((name, position))
+            async with controller.admit(on_position=on_position):
+                await release.wait()
+        
+        tasks = [asyncio.create_task(submit(f"s{i}")) for i in range(5)]
+        await asyncio.sleep(0.1)
+        
+        # Лимит — одно уведомление в секунду на всю очередь
+        assert len(notifications) == 1
+        release.set()
+        await asyncio.gather(*tasks)
+    
+    @pytest.mark.asyncio
+    async def test_limits_concurrency_and_reports_position(self):
+        """Тест очереди FIFO с уведомлением о месте в очереди"""
+        controller = AdmissionController(max_concurrent=1, max_queue=10)
+        release = asyncio.Event()
+        positions = []
+        order = []
+        
+        async def submit(name, on_position=None):
+            async with controller.admit(on_position=on_position):
+                order.append(name)
+                await release.wait()
+        
+        async def on_position(position):
+            positions.append(position)
+        
+        first = asyncio.create_task(submit("first"))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(submit("second"))
+        third = asyncio.create_task(submit("third", on_position))
+        await asyncio.sleep(0.01)
+        
+        assert order == ["first"]
+        assert controller.active == 1
+        assert len(controller.waiters) == 2
+        assert positions == [2]
+        
+        release.set()
+        await asyncio.gather(first, second, third)
+        
+        assert order == ["first", "second", "third"]
+        assert controller.active == 0
+    
+    @pytest.mark.asyncio
+    async def test_rejects_when_queue_full(self):
+        """Тест отказа при переполнении очереди"""
+        controller = AdmissionController(max_concurrent=1, max_queue=1)
+        release = asyncio.Event()
+        
+        async def submit():
+            async with controller.admit():
+                await release.wait()
+        
+        tasks = [asyncio.create_task(submit()) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        
+        with pytest.raises(AdmissionRejected):
+            async with controller.admit():
+                pass
+        
+        release.set()
+        await asyncio.gather(*tasks)
+    
+    @pytest.mark.asyncio
+    async def test_cancelled_waiter_leaves_queue(self):
+        """Тест удаления отмененного ожидания из очереди"""
+        controller = AdmissionController(max_concurrent=1)
+        release = asyncio.Event()
+        
+        async def submit():
+            async with controller.admit():
+                await release.wait()
+        
+        running = asyncio.create_task(submit())
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(submit())
+        await asyncio.sleep(0.01)
+        
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert len(controller.waiters) == 0
+        
+        release.set()
+        await running
+        assert controller.active == 0
+    
+    @pytest.mark.asyncio
+    async def test_weighted_fair_priorities(self):
+        """Тест опережения срочных обращений без простоя остальных"""
+        controller = AdmissionController(
+            max_concurrent=1, class_weights={'urgent': 4, 'normal': 1}, urgent_classes={'urgent'}
+        )
+        release = asyncio.Event()
+        order = []
+        
+        async def submit(priority, wait=False):
+            async with controller.admit(priority=priority):
+                order.append(priority)
+                if wait:
+                    await release.wait()
+        
+        blocker = asyncio.create_task(submit('normal', wait=True))
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(submit('normal')) for _ in range(4)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(submit('urgent')) for _ in range(8)]
+        await asyncio.sleep(0.01)
+        
+        release.set()
+        await asyncio.gather(blocker, *tasks)
+        
+        dispatched = order[1:]
+        assert dispatched[:3] == ['urgent'] * 3
+        assert 'normal' in dispatched[:5]
+        assert dispatched.count('urgent') == 8
+        assert delivery_latency_histogram.count(priority='urgent') >= 8
+    
+    @pytest.mark.asyncio
+    async def test_reserved_capacity_for_urgent(self):
+        """Тест резерва слотов отправки и каналов для срочных обращений"""
+        controller = AdmissionController(
+            max_concurrent=2,
+            channel_limits={'smtp': 2},
+            urgent_classes={'urgent'},
+            reserved_slots=1
+        )
+        release = asyncio.Event()
+        
+        async def deliver(priority):
+            async with controller.admit(priority=priority), controller.channel('smtp', priority):
+                await release.wait()
+        
+        first = asyncio.create_task(deliver('normal'))
+        second = asyncio.create_task(deliver('normal'))
+        await asyncio.sleep(0.01)
+        assert controller.active == 1
+        assert controller.queued('normal') == 1
+        
+        urgent = asyncio.create_task(deliver('urgent'))
+        await asyncio.sleep(0.01)
+        assert controller.active == 2
+        assert controller.channels['smtp'].in_use == 2
+        
+        release.set()
+        await asyncio.gather(first, second, urgent)
+        assert controller.active == 0
+        assert controller.channels['smtp'].in_use == 0
+        assert parse_priorities("Организация питания=low; Нарушение прав обучающихся=urgent") == {
+            'Организация питания': 'low', 'Нарушение прав обучающихся': 'urgent'
+        }
+
+
+class TestReplyRouting:
+    """Тесты пересылки ответов оператора"""
+    
+    def test_index_bounds_and_persistence(self, tmp_path):
+        """Тест ограничения индекса и восстановления из журнала"""
+        path = str(tmp_path / "reply_index.jsonl")
+        index = ReplyIndex(path=path, max_entries=3)
+        
+        index.add([10, 11], chat_id=555, appeal_id="a1")
+        index.add([20, 21], chat_id=777, appeal_id="a2")
+        
+        assert index.lookup(10) is None  # Вытеснено лимитом
+        assert index.lookup(11).chat_id == 555
+        assert index.lookup(21).appeal_id == "a2"
+        
+        restored = ReplyIndex(path=path, max_entries=3)
+        restored.load()
+        assert len(restored) == 3
+        assert restored.lookup(20) == index.lookup(20)
+    
+    def test_index_ttl(self):
+        """Тест истечения срока хранения записей"""
+        index = ReplyIndex(ttl=60)
+        index.add([1], chat_id=555, appeal_id="a1")
+        
+        with patch('reply_index.time.time', return_value=time.time() + 120):
+            assert index.lookup(1) is None
+    
+    @pytest.mark.asyncio
+    @patch('bot.bot')
+    async def test_journal_error_not_channel_failure(self, mock_bot, tmp_path):
+        """Тест доставки карточки при ошибке записи журнала индекса"""
+        mock_bot.send_message = AsyncMock(return_value=Mock(message_id=123))
+        index = ReplyIndex(path=str(tmp_path / "missing" / "reply_index.jsonl"))
+        index.compact()  # Ошибка записи журнала не выбрасывается
+        appeal = Appeal(
+            instance="Директор",
+            topic="Тема",
+            text="Текст",
+            full_name="Тестов Тест",
+            contact_method="Telegram",
+            chat_id=555
+        )
+        
+        telegram_breaker.reset()
+        with patch('bot.reply_index', index):
+            assert await send_to_operator(appeal) == True
+        
+        assert telegram_breaker.failures == 0
+        assert index.lookup(123).chat_id == 555
+    
+    @pytest.mark.asyncio
+    @patch('bot.bot')
+    async def test_operator_reply_relayed(self, mock_bot):
+        """Тест пересылки ответа оператора студенту"""
+        mock_bot.send_message = AsyncMock()
+        message = Mock()
+        message.reply_to_message.message_id = 123
+        message.copy_to = AsyncMock()
+        message.reply = AsyncMock()
+        
+        with patch('bot.reply_index', ReplyIndex()) as index:
+            index.add([123], chat_id=555, appeal_id="a1")
+            await operator_reply(message)
+        
+        assert mock_bot.send_message.call_args[1]['chat_id'] == 555
+        message.copy_to.assert_called_once_with(chat_id=555)
+        assert "отправлен" in message.reply.call_args[0][0]
+    
+    @pytest.mark.asyncio
+    @patch('bot.bot')
+    async def test_send_to_operator_registers_messages(self, mock_bot):
+        """Тест регистрации карточки и вложений в индексе"""
+        mock_bot.send_message = AsyncMock(return_value=Mock(message_id=1))
+        mock_bot.send_media_group = AsyncMock(return_value=[Mock(message_id=2), Mock(message_id=3)])
+        appeal = Appeal(
+            instance="Директор",
+            topic="Обращение с файлами",
+            text="Прикладываю несколько файлов",
+            full_name="Файлов Файл Файлович",
+            contact_method="Telegram",
+            media_files=[
+                {'type': 'photo', 'file_id': 'photo1', 'file_name': 'img1.jpg', 'file_size': 1024},
+                {'type': 'photo', 'file_id': 'photo2', 'file_name': 'img2.jpg', 'file_size': 1024}
+            ],
+            chat_id=555
+        )
+        
+        with patch('bot.reply_index', ReplyIndex()) as index, patch('bot.OPERATOR_ID', 123456789):
+            assert await send_to_operator(appeal) == True
+        
+        assert [index.lookup(i).appeal_id for i in (1, 2, 3)] == [appeal.appeal_id] * 3
+
+
+class TestAppealStore:
+    """Тесты хранилища обращений и панели оператора"""
+    
+    @staticmethod
+    def make_store(tmp_path, count=5):
+        store = AppealStore(str(tmp_path / "appeals.db"))
+        for i in range(count):
+            appeal = Appeal(
+                instance="Организация питания" if i % 2 else "Организация учебного процесса",
+                topic=f"Обращение {i}",
+                text="Текст обращения",
+                full_name="Иванов Иван Иванович",
+                contact_method="Telegram",
+                created_at=datetime(2025, 6, 1 + i, 12, 0)
+            )
+            store.save(appeal.to_dict())
+        return store
+    
+    def test_database_created_on_first_use(self, tmp_path):
+        """Тест создания файла базы только при первой операции"""
+        path = tmp_path / "appeals.db"
+        store = AppealStore(str(path))
+        assert not path.exists()
+        
+        assert store.get("missing") is None
+        assert path.exists()
+    
+    def test_read_only_store(self, tmp_path, capsys):
+        """Тест открытия базы только на чтение для панели и выгрузки"""
+        missing = tmp_path / "wrong.db"
+        with pytest.raises(FileNotFoundError):
+            AppealStore(str(missing), read_only=True)
+        assert export_main(["--db", str(missing)]) == 1
+        assert "wrong.db" in capsys.readouterr().err
+        assert not missing.exists()
+        
+        self.make_store(tmp_path, count=2)
+        reader = AppealStore(str(tmp_path / "appeals.db"), read_only=True)
+        assert len(reader.list(limit=10)[0]) == 2
+        with pytest.raises(sqlite3.OperationalError):
+            reader.save(Appeal(
+                instance="Директор", topic="Тема", text="Текст",
+                full_name="Тестов Тест", contact_method="Telegram"
+            ).to_dict())
+    
+    def test_keyset_pagination_and_filters(self, tmp_path):
+        """Тест курсорной пагинации и фильтров"""
+        store = self.make_store(tmp_path)
+        
+        page, cursor = store.list(limit=2)
+        assert [item['topic'] for item in page] == ["Обращение 4", "Обращение 3"]
+        page, cursor = store.list(limit=2, cursor=cursor)
+        assert [item['topic'] for item in page] == ["Обращение 2", "Обращение 1"]
+        page, cursor = store.list(limit=2, cursor=cursor)
+        assert [item['topic'] for item in page] == ["Обращение 0"]
+        assert cursor is None
+        
+        page, _ = store.list(instance="Организация питания", date_to=date(2025, 6, 2))
+        assert [item['topic'] for item in page] == ["Обращение 1"]
+        
+        with pytest.raises(ValueError):
+            store.list(cursor="not-a-cursor")
+    
+    def test_dashboard_conditional_requests(self, tmp_path):
+        """Тест ETag/Last-Modified и пагинации в API панели"""
+        store = self.make_store(tmp_path)
+        client = create_app(store).test_client()
+        
+        response = client.get("/api/appeals?limit=3")
+        assert response.status_code == 200
+        assert len(response.json['items']) == 3
+        etag = response.headers['ETag']
+        
+        next_page = client.get(f"/api/appeals?limit=3&cursor={response.json['next_cursor']}")
+        assert [item['topic'] for item in next_page.json['items']] == ["Обращение 1", "Обращение 0"]
+        
+        assert client.get("/api/appeals", headers={'If-None-Match': etag}).status_code == 304
+        assert client.get("/", headers={'If-None-Match': etag}).status_code == 304
+        
+        store.save(Appeal(
+            instance="Организация питания",
+            topic="Новое обращение",
+            text="Текст обращения",
+            full_name="Петров Петр Петрович",
+            contact_method="Telegram"
+        ).to_dict())
+        assert client.get("/api/appeals", headers={'If-None-Match': etag}).status_code == 200
+        assert client.get("/api/appeals?from=2025-13-01").status_code == 400
+    
+    def test_dashboard_token(self, tmp_path):
+        """Тест доступа к панели по токену"""
+        client = create_app(self.make_store(tmp_path, count=1), token="secret").test_client()
+        
+        assert client.get("/api/appeals").status_code == 401
+        assert client.get("/api/appeals", headers={'Authorization': "Bearer secret"}).status_code == 200
+
+
+class TestExport:
+    """Тесты выгрузки обращений"""
+    
+    @staticmethod
+    def make_store(tmp_path):
+        store = AppealStore(str(tmp_path / "appeals.db"))
+        for day, instance in [(5, "Организация питания"), (20, "Организация питания"), (3, "Директор")]:
+            store.save(Appeal(
+                instance=instance,
+                topic=f"Обращение {day}",
+                text="Текст, с запятой и \"кавычками\"",
+                full_name="Иванов Иван Иванович",
+                contact_method="+7 900 000-00-00",
+                media_files=[{'type': 'photo', 'file_id': 'p1', 'file_name': 'photo_1.jpg', 'file_size': 1024}],
+                created_at=datetime(2025, 6 if day != 3 else 7, day, 12, 0)
+            ).to_dict())
+        return store
+    
+    def test_csv_month_and_instance(self, tmp_path):
+        """Тест выгрузки в CSV за месяц по инстанции"""
+        output = tmp_path / "june.csv"
+        date_from, date_to = month_range("2025-06")
+        
+        count = export_appeals(
+            self.make_store(tmp_path), "csv", output=str(output),
+            instance="Организация питания", date_from=date_from, date_to=date_to
+        )
+        
+        rows = list(csv.DictReader(output.open(encoding="utf-8")))
+        assert count == 2
+        assert [row['topic'] for row in rows] == ["Обращение 5", "Обращение 20"]
+        assert rows[0]['text'] == "Текст, с запятой и \"кавычками\""
+        assert rows[0]['attachments_count'] == "1"
+        assert rows[0]['full_name'] == "Иванов Иван Иванович"
+    
+    def test_jsonl_redacted(self, tmp_path):
+        """Тест выгрузки в JSON Lines со скрытием персональных данных"""
+        output = tmp_path / "all.jsonl"
+        
+        self.make_store(tmp_path)
+        
+        assert export_main(["--db", str(tmp_path / "appeals.db"), "--format", "jsonl",
+                            "--output", str(output), "--redact"]) == 0
+        
+        records = [json.loads(line) for line in output.open(encoding="utf-8")]
+        assert len(records) == 3
+        assert {record['full_name'] for record in records} == {"***"}
+        assert {record['contact_method'] for record in records} == {"***"}
+    
+    def test_parquet(self, tmp_path):
+        """Тест выгрузки в Parquet"""
+        pq = pytest.importorskip("pyarrow.parquet")
+        output = tmp_path / "all.parquet"
+        
+        assert export_appeals(self.make_store(tmp_path), "parquet", output=str(output)) == 3
+        assert pq.read_table(str(output)).num_rows == 3
+
+
+class TestAnalytics:
+    """Тесты инкрементальной статистики"""
+    
+    def test_p2_median(self):
+        """Тест потоковой оценки медианы"""
+        rng = random.Random(1)
+        values = [rng.expovariate(1 / 60) for _ in range(5000)]
+        sketch = P2Quantile(0.5)
+        for value in values:
+            sketch.add(value)
+        
+        exact = sorted(values)[len(values) // 2]
+        assert abs(sketch.value - exact) / exact < 0.05
+        
+        restored = P2Quantile.from_dict(json.loads(json.dumps(sketch.to_dict())))
+        assert restored.value == sketch.value
+    
+    def test_transitions_and_funnel(self, tmp_path):
+        """Тест учета шагов диалога и воронки"""
+        stats = Analytics(path=str(tmp_path / "analytics.json"))
+        waiting = AppealStates.waiting_for_agreement.state
+        confirming = AppealStates.confirming_appeal.state
+        
+        for user in range(4):
+            stats.on_state_change(user, None, waiting, now=0)
+            stats.on_state_change(user, waiting, None, now=10 + user)
+        stats.on_state_change(0, None, confirming, now=20)
+        stats.on_state_change(0, confirming, None, now=50)
+        stats.on_submitted("Организация питания", datetime(2025, 6, 30, 12, 0))
+        
+        assert stats.funnel[waiting] == 4
+        assert stats.conversion(waiting, confirming) == 0.25
+        assert stats.median(waiting) == 12
+        assert stats.median(confirming) == 30
+        assert stats.today("2025-06-30")["Организация питания"] == 1
+        assert stats.current == {}
+        
+        stats.save()
+        restored = Analytics(path=str(tmp_path / "analytics.json"))
+        restored.load()
+        assert restored.totals == stats.totals
+        assert restored.median(confirming) == 30
+    
+    def test_snapshot_is_detached(self):
+        """Тест независимости снимка от дальнейших изменений статистики"""
+        stats = Analytics()
+        waiting = AppealStates.waiting_for_agreement.state
+        for user in range(6):
+            stats.on_state_change(user, None, waiting, now=0)
+            stats.on_state_change(user, waiting, None, now=user)
+        stats.on_submitted("Директор", datetime(2025, 6, 30, 12, 0))
+        
+        snapshot = stats.to_dict()
+        expected = json.dumps(snapshot, sort_keys=True)
+        stats.on_submitted("Директор", datetime(2025, 7, 1, 12, 0))
+        for user in range(6):
+            stats.on_state_change(user, None, waiting, now=0)
+            stats.on_state_change(user, waiting, None, now=100 + user)
+        
+        assert json.dumps(snapshot, sort_keys=True) == expected
+    
+    @pytest.mark.asyncio
+    async def test_snapshot_task_survives_errors(self):
+        """Тест продолжения периодического сохранения после ошибки"""
+        mock_analytics = Mock()
+        mock_analytics.save.side_effect = [RuntimeError("dictionary changed size"), None, None]
+        
+        with patch('bot.analytics', mock_analytics), patch('bot.ANALYTICS_SNAPSHOT_INTERVAL', 0):
+            task = asyncio.create_task(save_analytics_snapshots())
+            for _ in range(100):
+                if mock_analytics.save.call_count >= 2:
+                    break
+                await asyncio.sleep(0.01)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        
+        assert mock_analytics.save.call_count >= 2
+        mock_analytics.save.assert_called_with(mock_analytics.to_dict.return_value)
+    
+    @pytest.mark.asyncio
+    async def test_storage_reports_transitions(self):
+        """Тест передачи смены состояний из хранилища"""
+        on_state_change = Mock()
+        storage = BoundedMemoryStorage(on_state_change=on_state_change)
+        key = StorageKey(bot_id=1, chat_id=1, user_id=1)
+        
+        await storage.set_state(key, AppealStates.entering_topic)
+        await storage.set_state(key, AppealStates.entering_topic)
+        await storage.set_state(key, None)
+        
+        assert on_state_change.call_args_list == [
+            ((key, None, AppealStates.entering_topic.state),),
+            ((key, AppealStates.entering_topic.state, None),)
+        ]
+    
+    def test_stats_report(self):
+        """Тест отчета /stats"""
+        stats = Analytics()
+        stats.on_submitted("Организация питания", datetime.now())
+        
+        with patch('bot.analytics', stats):
+            report = format_stats()
+        
+        assert "Сегодня:</b> 1" in report
+        assert "Организация питания: 1" in report
+        assert "Отправили: 1" in report
+
+
+class TestBotApiSession:
+    """Тесты настроенной сессии Bot API"""
+    
+    @staticmethod
+    def make_session(**kwargs):
+        return TunedAiohttpSession(retry_base_delay=0, method_timeouts={'getFile': 7}, **kwargs)
+    
+    def test_connector_settings(self):
+        """Тест параметров пула соединений"""
+        session = self.make_session(limit=20, limit_per_host=10, keepalive_timeout=15, ttl_dns_cache=60)
+        
+        assert session._connector_init['limit'] == 20
+        assert session._connector_init['limit_per_host'] == 10
+        assert session._connector_init['keepalive_timeout'] == 15
+        assert session._connector_init['ttl_dns_cache'] == 60
+        assert parse_timeouts("getFile=5, sendMediaGroup=90") == {'getFile': 5.0, 'sendMediaGroup': 90.0}
+    
+    @pytest.mark.asyncio
+    async def test_retries_idempotent_methods(self):
+        """Тест повтора идемпотентного запроса с таймаутом метода"""
+        session = self.make_session()
+        method = GetFile(file_id="file1")
+        calls = []
+        
+        async def make_request(self, bot, method, timeout=None):
+            calls.append(timeout)
+            if len(calls) < 3:
+                raise TelegramNetworkError(method=method, message="timeout")
+            return "ok"
+        
+        with patch('bot_session.AiohttpSession.make_request', make_request):
+            assert await session.make_request(Mock(), method) == "ok"
+        
+        assert calls == [7, 7, 7]
+        assert api_retries_counter.get(method="getFile") >= 2
+        assert api_latency_histogram.count(method="getFile") >= 1
+    
+    @pytest.mark.asyncio
+    async def test_no_retry_for_sending(self):
+        """Тест отсутствия повторов для неидемпотентных методов"""
+        session = self.make_session()
+        method = SendMessage(chat_id=1, text="Текст")
+        make_request = AsyncMock(side_effect=TelegramNetworkError(method=method, message="timeout"))
+        
+        with patch('bot_session.AiohttpSession.make_request', make_request):
+            with pytest.raises(TelegramNetworkError):
+                await session.make_request(Mock(), method)
+        
+        assert make_request.call_count == 1
+    
+    @pytest.mark.asyncio
+    async def test_retry_after_for_any_method(self):
+        """Тест повтора после flood control для любого метода"""
+        session = self.make_session()
+        method = SendMessage(chat_id=1, text="Текст")
+        make_request = AsyncMock(side_effect=[
+            TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=0), "ok"
+        ])
+        
+        with patch('bot_session.AiohttpSession.make_request', make_request):
+            assert await session.make_request(Mock(), method) == "ok"
+        
+        assert make_request.call_count == 2
+    
+    @pytest.mark.asyncio
+    async def test_retried_edit_already_applied(self):
+        """Тест повтора редактирования, первая попытка которого дошла до Telegram"""
+        session = self.make_session()
+        method = EditMessageText(chat_id=1, message_id=2, text="⏳ Отправляем ваше обращение...")
+        not_modified = TelegramBadRequest(method=method, message="Bad Request: message is not modified")
+        make_request = AsyncMock(side_effect=[
+            TelegramNetworkError(method=method, message="timeout"), not_modified
+        ])
+        
+        with patch('bot_session.AiohttpSession.make_request', make_request):
+            assert await session.make_request(Mock(), method) is True
+        
+        # Без предшествующей сетевой ошибки ответ остается ошибкой
+        with patch('bot_session.AiohttpSession.make_request', AsyncMock(side_effect=not_modified)):
+            with pytest.raises(TelegramBadRequest):
+                await session.make_request(Mock(), method)
+
+
+class TestLocalBotApi:
+    """Тесты работы с локальным сервером Bot API"""
+    
+    def test_encode_base64_file(self, tmp_path):
+        """Тест кодирования файла по блокам"""
+        path = tmp_path / "scan.pdf"
+        content = bytes(range(256)) * 1000
+        path.write_bytes(content)
+        out = io.BytesIO()
+        encode_base64_file(path, out)
+        assert out.getvalue() == base64.encodebytes(content)
+        
+        empty = tmp_path / "empty.pdf"
+        empty.write_bytes(b"")
+        out = io.BytesIO()
+        encode_base64_file(empty, out)
+        assert out.getvalue() == b""
+    
+    def test_media_size_limit(self):
+        """Тест ограничения размера файла в облачном и локальном режимах"""
+        assert media_size_limit(0, is_local=False) == 10 * 1024 * 1024
+        assert media_size_limit(100 * 1024 * 1024, is_local=False) == CLOUD_DOWNLOAD_LIMIT
+        assert media_size_limit(100 * 1024 * 1024, is_local=True) == 100 * 1024 * 1024
+    
+    @pytest.mark.asyncio
+    @patch('bot.smtplib.SMTP')
+    async def test_send_email_reads_local_file(self, mock_smtp, tmp_path):
+        """Тест вложения файла с диска при работе через локальный сервер"""
+        content = b"%PDF-1.4 local file" * 1000
+        (tmp_path / "documents").mkdir()
+        (tmp_path / "documents" / "file_0.pdf").write_bytes(content)
+        
+        async def get_file(request):
+            return web.json_response({"ok": True, "result": {
+                "file_id": "doc1", "file_unique_id": "u1", "file_size": len(content),
+                "file_path": "/var/lib/telegram-bot-api/documents/file_0.pdf",
+            }})
+        
+        app = web.Application()
+        app.router.add_post("/bot{token}/getFile", get_file)
+        server = test_utils.TestServer(app)
+        await server.start_server()
+        
+        session = TunedAiohttpSession(api=local_api_server(
+            str(server.make_url("/")), f"/var/lib/telegram-bot-api:{tmp_path}"
+        ))
+        local_bot = Bot(token="123456:TEST", session=session)
+        mock_server = smtp_server_mock()
+        mock_smtp.return_value = mock_server
+        appeal = Appeal(
+            instance="Директор",
+            topic="Вложение",
+            text="Текст",
+            full_name="Тестов Тест",
+            contact_method="test@example.com",
+            doc_files=[{'type': 'document', 'file_id': 'doc1', 'file_name': 'scan.pdf', 'file_size': len(content)}]
+        )
+        
+        try:
+            smtp_breaker.reset()
+            with patch('bot.bot', local_bot):
+                assert await send_email(appeal) == True
+        finally:
+            await session.close()
+            await server.close()
+        
+        sent = email.message_from_bytes(bytes(mock_server.sent[:-len(b".\r\n")]))
+        attachment = sent.get_payload()[1]
+        assert attachment.get_filename() == "scan.pdf"
+        assert attachment.get_payload(decode=True) == content
+
+
+class TestMailStream:
+    """Тесты сборки и отправки письма из временного файла"""
+    
+    def test_spooled_message_structure(self):
+        """Тест письма с вложением, записанным по частям, и удаления сбойного вложения"""
+        msg = MIMEMultipart()
+        msg['Subject'] = "[Директор] Тема"
+        content = b"\x00\x01 binary" * 5000
+        
+        with MessageSpool(msg, max_size=1024) as message:
+            message.add(MIMEText("Текст обращения", 'plain', 'utf-8'))
+            part = MIMEBase('application', 'octet-stream')
+            part['Content-Transfer-Encoding'] = 'base64'
+            part.add_header('Content-Disposition', 'attachment; filename= scan.pdf')
+            with message.attachment(part) as out:
+                encode_base64_stream(io.BytesIO(content), out)
+            with pytest.raises(OSError):
+                with message.attachment(part) as out:
+                    out.write(b"QUJD\n")
+                    raise OSError("read error")
+            parsed = email.message_from_binary_file(message.finish())
+        
+        text, attachment = parsed.get_payload()
+        assert str(email.header.make_header(email.header.decode_header(parsed['Subject']))) == "[Директор] Тема"
+        assert text.get_payload(decode=True).decode("utf-8") == "Текст обращения"
+        assert attachment.get_payload(decode=True) == content
+    
+    def test_send_message_file_dot_stuffing(self):
+        """Тест передачи письма с CRLF и удвоением начальной точки"""
+        server = smtp_server_mock()
+        message = io.BytesIO(b"Subject: test\n\n.hidden line\nlast line")
+        
+        send_message_file(server, "from@test.com", "to@test.com", message, block_size=8)
+        
+        assert bytes(server.sent) == b"Subject: test\r\n\r\n..hidden line\r\nlast line\r\n.\r\n"
+        server.docmd.assert_called_once_with("data")
+    
+    def test_send_message_file_rejected(self):
+        """Тест ошибки при отказе сервера принять письмо"""
+        server = smtp_server_mock()
+        server.getreply.return_value = (552, b"Message too large")
+        
+        with pytest.raises(smtplib.SMTPDataError):
+            send_message_file(server, "from@test.com", "to@test.com", io.BytesIO(b"body\n"))
+
+
+class TestAttachments:
+    """Тесты компактного представления вложений"""
+    
+    def test_attachment_representations(self):
+        """Тест преобразования вложения из кортежа FSM и словаря"""
+        attachment = Attachment('photo', 'p1', 'photo_1.jpg', 1024)
+        
+        assert attachment.to_tuple() == ('photo', 'p1', 'photo_1.jpg', 1024)
+        assert Attachment.from_value(list(attachment.to_tuple())) == attachment
+        assert Attachment.from_value(attachment.to_dict()) == attachment
+        assert attachment.file_name == 'photo_1.jpg'
+        assert not hasattr(attachment, '__dict__')
+    
+    def test_appeal_from_fsm_data(self):
+        """Тест создания обращения из кортежей в данных FSM"""
+        appeal = Appeal(
+            instance="Директор",
+            topic="Тема",
+            text="Текст",
+            full_name="Тестов Тест",
+            contact_method="test@example.com",
+            media_files=[('photo', 'p1', 'photo_1.jpg', 1024)],
+            doc_files=[('document', 'd1', 'doc.pdf', 2048)]
+        )
+        
+        assert not hasattr(appeal, '__dict__')
+        assert appeal.media_files[0].file_id == 'p1'
+        assert appeal.to_dict()['doc_files'] == [
+            {'type': 'document', 'file_id': 'd1', 'file_name': 'doc.pdf', 'file_size': 2048}
+        ]
+        assert Appeal.from_dict(json.loads(json.dumps(appeal.to_dict()))) == appeal
+
+
+class TestSubmissionGuard:
+    """Тесты защиты от повторной отправки"""
+    
+    def test_completed_keys_expire(self):
+        """Тест хранения ключей отправленных черновиков"""
+        guard = SubmissionGuard(ttl=60, max_entries=2)
+        guard.complete("draft1", "appeal1")
+        
+        assert guard.result("draft1") == "appeal1"
+        assert guard.result("draft2") is None
+        assert guard.result(None) is None
+        
+        with patch('idempotency.time.monotonic', return_value=time.monotonic() + 120):
+            assert guard.result("draft1") is None
+        
+        for key in ("a", "b", "c"):
+            guard.complete(key, key)
+        assert list(guard.completed) == ["b", "c"]
+    
+    @pytest.mark.asyncio
+    async def test_lock_released(self):
+        """Тест блокировки пользователя на время отправки"""
+        guard = SubmissionGuard()
+        
+        async with guard.submitting(1):
+            assert guard.busy(1)
+            assert not guard.busy(2)
+        
+        assert not guard.busy(1)
+        assert guard.locks == {}
+    
+    @pytest.mark.asyncio
+    async def test_duplicate_callbacks_not_delivered(self):
+        """Тест ответа на повторные нажатия без повторной доставки"""
+        release = asyncio.Event()
+        
+        async def submit(callback, state, draft_id, delivery):
+            await release.wait()
+            submissions.complete(draft_id, draft_id)
+        
+        def make_callback():
+            callback = Mock()
+            callback.data = "send_appeal:draft1"
+            callback.from_user.id = 42
+            callback.answer = AsyncMock()
+            return callback
+        
+        state = Mock()
+        state.get_state = AsyncMock(return_value=AppealStates.confirming_appeal.state)
+        first, second, third = make_callback(), make_callback(), make_callback()
+        
+        with patch('bot.submissions', SubmissionGuard()) as submissions, \
+             patch('bot.submit_appeal', side_effect=submit) as submit_appeal:
+            task = asyncio.create_task(send_appeal(first, state))
+            await asyncio.sleep(0)
+            
+            await send_appeal(second, state)
+            second.answer.assert_awaited_once_with("⏳ Обращение уже отправляется")
+            
+            release.set()
+            await task
+            await send_appeal(third, state)
+        
+        third.answer.assert_awaited_once_with("✅ Это обращение уже отправлено")
+        assert submit_appeal.call_count == 1
+
+
+    @pytest.mark.asyncio
+    async def test_rejected_submission_not_counted(self):
+        """Тест учета в статистике только принятых в очередь обращений"""
+        @asynccontextmanager
+        async def reject(on_position=None, priority=None):
+            raise AdmissionRejected()
+            yield
+        
+        callback = Mock()
+        callback.message.chat.id = 42
+        callback.message.edit_text = AsyncMock()
+        callback.answer = AsyncMock()
+        state = Mock()
+        state.get_data = AsyncMock(return_value={
+            'instance': "Директор", 'topic': "Тема", 'text': "Текст",
+            'full_name': "Тестов Тест", 'contact_method': "Telegram"
+        })
+        
+        with patch('bot.admission') as admission, patch('bot.analytics') as analytics, \
+             patch('bot.appeal_store'):
+            admission.admit = reject
+            await submit_appeal(callback, state, "draft1", Delivery(None, ('telegram', 'smtp')))
+        
+        analytics.on_submitted.assert_not_called()
+        # Колбэк отвечен до постановки в очередь
+        callback.answer.assert_awaited_once()
+
+
+class TestTracing:
+    """Тесты трассировки обращений"""
+    
+    @staticmethod
+    def read_spans(path):
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+    
+    def test_tail_sampling(self, tmp_path):
+        """Тест записи только неудачных и медленных трассировок"""
+        path = tmp_path / "traces.jsonl"
+        tracer = Tracer(path=str(path), slow_threshold=10, sample_rate=0)
+        
+        with tracer.start_span("receive_text", trace_id="fast"):
+            pass
+        tracer.finish("fast", outcome="submitted")
+        assert not path.exists()
+        
+        with pytest.raises(RuntimeError):
+            with tracer.start_span("send_appeal", trace_id="broken"):
+                with tracer.start_span("smtp"):
+                    raise RuntimeError("SMTP недоступен")
+        with tracer.start_span("receive_text", trace_id="partial"):
+            pass
+        tracer.finish("broken", outcome="submitted")
+        tracer.finish("partial", failed=True, outcome="submitted")
+        
+        spans = self.read_spans(path)
+        assert [(s["traceId"], s["name"]) for s in spans] == [
+            ("broken", "smtp"), ("broken", "send_appeal"), ("partial", "receive_text")
+        ]
+        assert spans[0]["status"]["code"] == "STATUS_CODE_ERROR"
+        assert spans[0]["parentSpanId"] == spans[1]["spanId"]
+        assert spans[1]["attributes"]["sampling.reason"] == "error"
+        assert tracer.buffers == {}
+    
+    def test_trace_file_rotation(self, tmp_path):
+        """Тест ротации файла трассировок по размеру"""
+        path = tmp_path / "traces.jsonl"
+        tracer = Tracer(path=str(path), sample_rate=1, max_bytes=1, backup_count=2)
+        
+        for trace_id in ("first", "second", "third", "fourth"):
+            with tracer.start_span("receive_text", trace_id=trace_id):
+                pass
+            tracer.finish(trace_id, outcome="submitted")
+        
+        assert [s["traceId"] for s in self.read_spans(path)] == ["fourth"]
+        assert [s["traceId"] for s in self.read_spans(f"{path}.1")] == ["third"]
+        assert [s["traceId"] for s in self.read_spans(f"{path}.2")] == ["second"]
+        assert not (tmp_path / "traces.jsonl.3").exists()
+    
+    @pytest.mark.asyncio
+    async def test_middleware_traces_handler_and_api_calls(self, tmp_path):
+        """Тест трассировки обработчика и исходящих запросов по draft_id"""
+        path = tmp_path / "traces.jsonl"
+        session = TunedAiohttpSession()
+        state = Mock()
+        state.get_data = AsyncMock(return_value={'draft_id': 'draft1'})
+        
+        async def receive_media(event, data):
+            await session.make_request(Mock(), GetFile(file_id="file1"))
+            finish_trace('draft1', outcome='submitted')
+        
+        data = {'state': state, 'handler': Mock(callback=receive_media), 'raw_state': 'AppealStates:uploading_media'}
+        
+        with patch('tracing.tracer', Tracer(path=str(path), sample_rate=1)), \
+             patch('bot_session.AiohttpSession.make_request', AsyncMock(return_value="ok")):
+            await TracingMiddleware()(receive_media, Mock(), data)
+        
+        api_span, handler_span = self.read_spans(path)
+        assert api_span["name"] == "bot_api.getFile"
+        assert api_span["parentSpanId"] == handler_span["spanId"]
+        assert handler_span["name"] == "receive_media"
+        assert handler_span["traceId"] == api_span["traceId"] == "draft1"
+        assert handler_span["attributes"]["outcome"] == "submitted"
+    
+    @pytest.mark.asyncio
+    async def test_trace_started_inside_handler(self):
+        """Тест привязки спана к трассировке, начатой обработчиком"""
+        tracer = Tracer(path="unused.jsonl")
+        state = Mock()
+        state.get_data = AsyncMock(return_value={})
+        
+        async def start_new_appeal(event, data):
+            bind_trace('draft2')
+            with span("outside"):
+                pass
+        
+        with patch('tracing.tracer', tracer):
+            await TracingMiddleware()(start_new_appeal, Mock(), {'state': state, 'handler': None})
+        
+        assert [s.name for s in tracer.buffers['draft2']] == ["outside", "Mock"]
+
+
 # Запуск тестов
 if __name__ == "__main__":
     # Запуск всех тестов
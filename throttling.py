@@ -0,0 +1,139 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, TelegramObject
+
+logger = logging.getLogger(__name__)
+
+# Лимит: (количество событий, длина окна в секундах)
+Limit = Tuple[int, float]
+
+
+def parse_limit(value: str) -> Limit:
+    """Разбор лимита вида «20/60» (событий за секунд)"""
+    count, period = value.split("/")
+    return int(count), float(period)
+
+
+def parse_limits(value: str) -> Dict[str, Limit]:
+    """Разбор списка лимитов вида «receive_media=30/60,unknown_message=5/60»"""
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, limit = item.split("=")
+        limits[name.strip()] = parse_limit(limit.strip())
+    return limits
+
+
+class SlidingWindow:
+    """
+    Счетчик скользящего окна на двух соседних фиксированных окнах.
+
+    Число событий за последние period секунд оценивается как
+    current + previous * (доля предыдущего окна, попадающая в скользящее).
+    Хранит три числа на пользователя, все операции O(1).
+    """
+
+    __slots__ = ("window_start", "previous", "current")
+
+    def __init__(self, now: float) -> None:
+        self.window_start = now
+        self.previous = 0
+        self.current = 0
+
+    def hit(self, now: float, limit: int, period: float) -> bool:
+        """Учет события, возвращает False при превышении лимита"""
+        elapsed = now - self.window_start
+        if elapsed >= period:
+            windows = int(elapsed // period)
+            self.previous = self.current if windows == 1 else 0
+            self.current = 0
+            self.window_start += windows * period
+            elapsed -= windows * period
+
+        weight = (period - elapsed) / period
+        if self.previous * weight + self.current >= limit:
+            return False
+
+        self.current += 1
+        return True
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничение частоты событий от одного пользователя.
+
+    Лимит выбирается по имени обработчика, затем по состоянию FSM,
+    иначе используется лимит по умолчанию. Лишние события отбрасываются
+    до вызова обработчика.
+    """
+
+    def __init__(
+        self,
+        default_limit: Limit = (20, 60.0),
+        limits: Optional[Dict[str, Limit]] = None,
+        max_tracked: int = 50000,
+    ) -> None:
+        self.default_limit = default_limit
+        self.limits = limits or {}
+        self.max_tracked = max_tracked
+        self.windows: "OrderedDict[Tuple[int, str], SlidingWindow]" = OrderedDict()
+        self.dropped = 0
+
+    def resolve_limit(self, data: Dict[str, Any]) -> Tuple[str, Limit]:
+        """Выбор лимита для события"""
+        handler = data.get("handler")
+        if handler is not None:
+            name = handler.callback.__name__
+            if name in self.limits:
+                return name, self.limits[name]
+
+        state = data.get("raw_state")
+        if state is not None and state in self.limits:
+            return state, self.limits[state]
+
+        return "default", self.default_limit
+
+    def allow(self, user_id: int, scope: str, limit: Limit, now: Optional[float] = None) -> bool:
+        if now is None:
+            now = time.monotonic()
+
+        key = (user_id, scope)
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = SlidingWindow(now)
+            # Забываем самых давно активных пользователей
+            if len(self.windows) > self.max_tracked:
+                self.windows.popitem(last=False)
+        else:
+            self.windows.move_to_end(key)
+
+        return window.hit(now, *limit)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        scope, limit = self.resolve_limit(data)
+        if not self.allow(user.id, scope, limit):
+            self.dropped += 1
+            logger.warning(f"Превышен лимит запросов: пользователь {user.id}, {scope}")
+            if isinstance(event, CallbackQuery):
+                # Без ответа кнопка показывает загрузку до таймаута Telegram
+                try:
+                    await event.answer()
+                except Exception as e:
+                    logger.debug(f"Не удалось ответить на отброшенный колбэк: {e}")
+            return None
+
+        return await handler(event, data)
@@ -0,0 +1,300 @@
+import functools
+import json
+import logging
+import os
+import random
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+traces_exported_counter = REGISTRY.counter(
+    "hotline_traces_exported_total", "Трассировки, записанные в файл", ["reason"]
+)
+traces_dropped_counter = REGISTRY.counter(
+    "hotline_traces_dropped_total", "Трассировки, отброшенные при выборке"
+)
+
+# Текущий (самый вложенный) открытый спан задачи
+current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """Отрезок работы внутри трассировки обращения"""
+
+    __slots__ = (
+        "trace_id", "span_id", "parent", "name", "attributes",
+        "start_ns", "end_ns", "error", "finish_attributes",
+    )
+
+    def __init__(
+        self, trace_id: Optional[str], parent: Optional["Span"], name: str, attributes: Dict
+    ) -> None:
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent = parent
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.error: Optional[str] = None
+        # Атрибуты трассировки, если она завершается вместе с этим спаном
+        self.finish_attributes: Optional[Dict] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def root(self) -> "Span":
+        span = self
+        while span.parent is not None:
+            span = span.parent
+        return span
+
+    def to_dict(self) -> Dict:
+        """Запись в духе OTLP/JSON"""
+        record = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent.span_id if self.parent is not None else "",
+            "name": self.name,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "attributes": self.attributes,
+            "status": {"code": "STATUS_CODE_OK"},
+        }
+        if self.error is not None:
+            record["status"] = {"code": "STATUS_CODE_ERROR", "message": self.error}
+        return record
+
+
+class Tracer:
+    """
+    Трассировка обращений с хвостовой выборкой.
+
+    Трассировка соответствует черновику обращения (draft_id из данных FSM)
+    и объединяет спаны всех обработчиков и исходящих запросов. Завершенные
+    спаны накапливаются в памяти; при завершении трассировки решается,
+    записывать ли ее: трассировки с ошибками и медленными спанами
+    (не короче slow_threshold секунд) записываются всегда, остальные —
+    с вероятностью sample_rate. Без файла трассировка отключена и спаны
+    не создаются. Как и лог бота, файл ротируется: при достижении
+    max_bytes он переименовывается в .1 (хранится backup_count копий).
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        slow_threshold: float = 5,
+        sample_rate: float = 0.01,
+        max_traces: int = 10000,
+        max_spans: int = 500,
+        max_bytes: int = 50 * 1024 * 1024,
+        backup_count: int = 3,
+    ) -> None:
+        self.path = path
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.max_traces = max_traces
+        self.max_spans = max_spans
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffers: "OrderedDict[str, List[Span]]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def configure(
+        self,
+        path: Optional[str],
+        slow_threshold: float,
+        sample_rate: float,
+        max_traces: int,
+        max_bytes: int,
+        backup_count: int,
+    ) -> None:
+        self.path = path
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.max_traces = max_traces
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+    @contextmanager
+    def start_span(self, name: str, trace_id: Optional[str] = None, **attributes: Any) -> Iterator[Optional[Span]]:
+        """Спан верхнего уровня (обработчик события) или вложенный в текущий"""
+        if not self.enabled:
+            yield None
+            return
+
+        parent = current_span.get()
+        if trace_id is None and parent is not None:
+            trace_id = parent.trace_id
+        span = Span(trace_id, parent, name, attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            current_span.reset(token)
+            span.end_ns = time.time_ns()
+            self._record(span)
+
+    def _record(self, span: Span) -> None:
+        if span.trace_id is None:
+            return
+        spans = self.buffers.get(span.trace_id)
+        if spans is None:
+            spans = self.buffers[span.trace_id] = []
+            if len(self.buffers) > self.max_traces:
+                # Самая давняя трассировка завершается принудительно
+                trace_id, evicted = self.buffers.popitem(last=False)
+                self._flush(trace_id, evicted, {"outcome": "evicted"})
+        else:
+            self.buffers.move_to_end(span.trace_id)
+        if len(spans) < self.max_spans:
+            spans.append(span)
+
+        if span.parent is None and span.finish_attributes is not None:
+            self._flush(span.trace_id, self.buffers.pop(span.trace_id), span.finish_attributes)
+
+    def finish(self, trace_id: Optional[str], failed: bool = False, **attributes: Any) -> None:
+        """
+        Завершение трассировки черновика.
+
+        failed — обращение не доставлено полностью (трассировка записывается
+        всегда). Внутри обработчика этой трассировки запись откладывается до
+        завершения его спана, чтобы он тоже попал в файл.
+        """
+        if not self.enabled or trace_id is None:
+            return
+        attributes["failed"] = failed
+        span = current_span.get()
+        if span is not None and span.trace_id == trace_id:
+            span.root().finish_attributes = attributes
+            return
+        spans = self.buffers.pop(trace_id, None)
+        if spans:
+            self._flush(trace_id, spans, attributes)
+
+    def _keep_reason(self, spans: List[Span], attributes: Dict) -> Optional[str]:
+        if attributes.get("failed") or any(span.error is not None for span in spans):
+            return "error"
+        if any(span.duration >= self.slow_threshold for span in spans):
+            return "slow"
+        if random.random() < self.sample_rate:
+            return "sampled"
+        return None
+
+    def _rotate(self) -> None:
+        """Переименование заполненного файла по схеме RotatingFileHandler"""
+        if self.backup_count <= 0:
+            os.remove(self.path)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def _flush(self, trace_id: str, spans: List[Span], attributes: Dict) -> None:
+        reason = self._keep_reason(spans, attributes)
+        if reason is None:
+            traces_dropped_counter.inc()
+            return
+
+        # Атрибуты трассировки записываются в последний спан верхнего уровня
+        last_root = next((span for span in reversed(spans) if span.parent is None), None)
+        attributes = {**attributes, "sampling.reason": reason}
+        try:
+            if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                self._rotate()
+            with open(self.path, "a", encoding="utf-8") as f:
+                for span in spans:
+                    record = span.to_dict()
+                    if span is last_root:
+                        record["attributes"] = {**span.attributes, **attributes}
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        except OSError as e:
+            logger.error(f"Ошибка записи трассировки {trace_id}: {e}")
+            return
+        traces_exported_counter.inc(reason=reason)
+
+
+# Трассировщик процесса; настраивается при запуске бота
+tracer = Tracer()
+_no_span = nullcontext()
+
+
+def span(name: str, **attributes: Any):
+    """Вложенный спан; вне обработчика (поллинг, фоновые задачи) не создается"""
+    if current_span.get() is None:
+        return _no_span
+    return tracer.start_span(name, **attributes)
+
+
+def bind_trace(trace_id: str) -> None:
+    """Привязка текущих спанов к трассировке, начатой внутри обработчика"""
+    current = current_span.get()
+    while current is not None:
+        if current.trace_id is None:
+            current.trace_id = trace_id
+        current = current.parent
+
+
+def finish_trace(trace_id: Optional[str], failed: bool = False, **attributes: Any) -> None:
+    tracer.finish(trace_id, failed=failed, **attributes)
+
+
+def traced(name: str):
+    """Спан на каждый вызов асинхронной функции"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_error(error: BaseException) -> None:
+    """Отметка ошибки, перехваченной внутри текущего спана"""
+    current = current_span.get()
+    if current is not None:
+        current.error = f"{type(error).__name__}: {error}"
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Спан на каждый обработчик; трассировка берется из данных FSM"""
+
+    def __init__(self, trace_key: str = "draft_id") -> None:
+        self.trace_key = trace_key
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not tracer.enabled:
+            return await handler(event, data)
+
+        trace_id = None
+        state = data.get("state")
+        if state is not None:
+            trace_id = (await state.get_data()).get(self.trace_key)
+
+        name = data["handler"].callback.__name__ if data.get("handler") is not None else type(event).__name__
+        with tracer.start_span(name, trace_id=trace_id, state=data.get("raw_state")):
+            return await handler(event, data)